@@ -0,0 +1,152 @@
+import os
+import glob
+import json
+import uuid
+import fcntl
+import atexit
+import logging
+import threading
+import metrics
+
+# Локальный журнал строк, ещё не записанных в Google Sheets
+JOURNAL_DIR = os.environ.get('JOURNAL_DIR', 'journal')
+# Строки уходят в лист пачкой при накоплении BATCH_SIZE штук или раз в FLUSH_INTERVAL секунд
+APPEND_BATCH_SIZE = int(os.environ.get('APPEND_BATCH_SIZE', '50'))
+APPEND_FLUSH_INTERVAL = float(os.environ.get('APPEND_FLUSH_INTERVAL', '2'))
+
+log = logging.getLogger(__name__)
+
+
+class AppendWriter:
+    """Пакетная запись строк в лист через локальный журнал.
+
+    append() пишет строку в журнал (append-only, по файлу на процесс) и сразу
+    возвращает управление; фоновый поток отправляет накопленное одним
+    append_rows. Журнал хранит строки {"row": [...]} и отметки {"done": n} —
+    сколько строк с начала файла уже в листе. При старте процесс забирает
+    журналы завершившихся процессов и дописывает то, что не успело уйти.
+    Доставка «хотя бы один раз»: падение между append_rows и отметкой
+    даст повтор строки.
+    """
+
+    def __init__(self, ws, name, journal_dir=JOURNAL_DIR,
+                 batch_size=APPEND_BATCH_SIZE, interval=APPEND_FLUSH_INTERVAL):
+        self.ws = ws
+        self.name = name
+        self.journal_dir = journal_dir
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = []
+        self._total = 0      # строк в текущем файле журнала
+        self._done = 0       # из них уже записано в лист
+        self._file = None
+        self._pid = None
+        metrics.queue(f'append_{name}', lambda: len(self._pending))
+
+    # --- Журнал ---
+    def _path(self, suffix):
+        return os.path.join(self.journal_dir, f'{self.name}-{suffix}.jsonl')
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    @staticmethod
+    def _read_pending(f):
+        rows, done = [], 0
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # недописанная последняя строка
+            if 'row' in entry:
+                rows.append(entry['row'])
+            else:
+                done = entry.get('done', done)
+        return rows[done:]
+
+    def _claim_orphans(self):
+        """Забирает незаписанные строки из журналов завершившихся процессов."""
+        own = self._file.name
+        for path in sorted(glob.glob(self._path('*'))):
+            if path == own:
+                continue
+            try:
+                f = open(path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # журнал живого процесса
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue  # уже забран другим процессом
+                rows = self._read_pending(f)
+                for row in rows:
+                    self._write({'row': row})
+                self._pending.extend(rows)
+                self._total += len(rows)
+                os.remove(path)
+            if rows:
+                log.info('%s: восстановлено %d строк из %s', self.name, len(rows), path)
+
+    def start(self):
+        """Открывает журнал процесса, подхватывает старые записи и запускает поток отправки."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pending, self._total, self._done = [], 0, 0
+            os.makedirs(self.journal_dir, exist_ok=True)
+            self._file = open(self._path(f'{self._pid}-{uuid.uuid4().hex[:8]}'), 'a', encoding='utf-8')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            self._claim_orphans()
+        threading.Thread(target=self._run, name=f'append-{self.name}', daemon=True).start()
+        atexit.register(self.flush)
+        if self._pending:
+            self._wakeup.set()
+
+    # --- Запись ---
+    def append(self, row):
+        """Ставит строку в очередь; после возврата строка уже лежит в журнале на диске."""
+        if self._pid != os.getpid():
+            self.start()
+        with self._lock:
+            self._write({'row': row})
+            self._pending.append(row)
+            self._total += 1
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception('%s: не удалось записать строки в лист, повторим позже', self.name)
+
+    def flush(self):
+        """Отправляет все накопленные строки в лист одним запросом."""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+            if not batch:
+                return
+            self.ws.append_rows(batch)
+            with self._lock:
+                del self._pending[:len(batch)]
+                self._done += len(batch)
+                if self._done == self._total:
+                    # всё записано — журнал можно обнулить
+                    self._file.truncate(0)
+                    self._file.seek(0)
+                    self._total = self._done = 0
+                else:
+                    self._write({'done': self._done})
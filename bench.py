@@ -0,0 +1,423 @@
+"""Нагрузочный прогон HTTP-ручек server.py и диалогов bot.py на локальных заменителях API.
+
+Ничего не ходит в сеть: Google Sheets, Drive и Telegram заменяются классами
+из fakes.py, данные лежат во временной папке. Для каждой операции печатаются
+пропускная способность, задержки p50/p95/p99 и число вызовов каждого API.
+
+    python bench.py                       # все сценарии
+    python bench.py -n 500 -c 16 --latency 0.05 --quota-rate 0.02
+    python bench.py --only experts_list,bot_consult --json result.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+CITIES = ["Москва", "Казань", "Пермь", "Омск", "Тверь"]
+SPHERES = ["право", "финансы", "психология", "IT"]
+EXPERT_HEADER = ['ФИО эксперта', 'Город', 'сфера', 'описание', 'photo_file_id', 'Telegram ID', 'Username', 'Slots']
+FIRST_EXPERT_ID = 10000
+FIRST_CLIENT_ID = 500000
+
+
+def make_sheets(experts, days=14, per_day=6, seed=1):
+    """Листы таблицы: experts экспертов со слотами на days дней вперёд."""
+    rnd = random.Random(seed)
+    today = date.today()
+    rows = [EXPERT_HEADER]
+    for i in range(experts):
+        slots = [
+            f"{(today + timedelta(days=d)).strftime('%d.%m.%y')} {h:02d}:00"
+            for d in range(1, days + 1) for h in sorted(rnd.sample(range(8, 23), per_day))
+        ]
+        rows.append([
+            f"Эксперт {i}", CITIES[i % len(CITIES)], SPHERES[i % len(SPHERES)], "Описание " * 20,
+            "", FIRST_EXPERT_ID + i, f"expert{i}", ";".join(slots),
+        ])
+    return {'Эксперты': rows, 'Users': [['Имя', 'Город']], 'Заявки': [['ФИО', 'эксперт', 'дата', 'время']]}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class Result:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self.calls = {}
+
+    def row(self, ops):
+        lat = [x * 1000 for x in self.latencies]
+        return {
+            'operation': self.name,
+            'ops': ops,
+            'errors': self.errors,
+            'ops_per_sec': round(ops / self.elapsed, 1) if self.elapsed else 0.0,
+            'p50_ms': round(percentile(lat, 50), 2),
+            'p95_ms': round(percentile(lat, 95), 2),
+            'p99_ms': round(percentile(lat, 99), 2),
+            'calls': self.calls,
+        }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix='kons-bench-')
+        os.environ.update({
+            'SHEET_ID': 'bench-sheet',
+            'DRIVE_FOLDER_ID': 'bench-folder',
+            'TELEGRAM_TOKEN': '1:bench',
+            'GSPREAD_CREDENTIALS_JSON': '{}',
+            'STORAGE_BACKEND': args.backend,
+            'GOOGLE_CACHE_DIR': os.path.join(self.tmp, 'google_cache'),
+            'JOURNAL_DIR': os.path.join(self.tmp, 'journal'),
+            'PHOTO_SPOOL_DIR': os.path.join(self.tmp, 'spool'),
+            'SQLITE_PATH': os.path.join(self.tmp, 'kons.db'),
+            'LEDGER_PATH': os.path.join(self.tmp, 'bookings.db'),
+            'SESSIONS_PATH': os.path.join(self.tmp, 'sessions.db'),
+            'REMINDERS_PATH': os.path.join(self.tmp, 'reminders.db'),
+        })
+        if args.sheets_rpm:
+            os.environ['SHEETS_REQUESTS_PER_MINUTE'] = str(args.sheets_rpm)
+        if args.drive_rpm:
+            os.environ['DRIVE_REQUESTS_PER_MINUTE'] = str(args.drive_rpm)
+        import fakes
+        self.fakes = fakes.FakeBackends(
+            sheets=make_sheets(args.experts), latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, quota_rate=args.quota_rate, seed=args.seed,
+        ).install()
+        import server
+        import bot
+        self.server = server
+        self.bot = bot
+        if args.backend == 'sqlite':
+            # эксперты загружаются из листа в потоке репликации бота
+            deadline = time.monotonic() + 60
+            while not bot.repo.imported() and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.rnd = random.Random(args.seed)
+        self._photo = None
+        self._clients = threading.local()
+        self.handler_errors = 0
+        bot.application.add_error_handler(self._on_error)
+
+    async def _on_error(self, update, context):
+        self.handler_errors += 1
+
+    # --- Подсчёт вызовов API ---
+    def _snapshot(self):
+        return {s.name: s.total() for s in self.fakes.services()}
+
+    def _measure(self, name, ops, run):
+        result = Result(name)
+        before = self._snapshot()
+        started = time.perf_counter()
+        run(result)
+        result.elapsed = result.elapsed or time.perf_counter() - started
+        # отложенные записи (журнал, репликация) тоже относятся к этой операции
+        self.server.repo.flush()
+        self.bot.repo.flush()
+        after = self._snapshot()
+        result.calls = {k: round((after[k] - before[k]) / ops, 2) for k in after}
+        return result.row(ops)
+
+    # --- HTTP-ручки ---
+    def _client(self):
+        client = getattr(self._clients, 'client', None)
+        if client is None:
+            client = self._clients.client = self.server.app.test_client()
+        return client
+
+    def _http(self, name, request):
+        n, c = self.args.requests, self.args.concurrency
+
+        def run(result):
+            def one(i):
+                t0 = time.perf_counter()
+                try:
+                    resp = request(self._client(), i)
+                    ok = resp.status_code < 400
+                except Exception:
+                    ok = False
+                result.latencies.append(time.perf_counter() - t0)
+                if not ok:
+                    result.errors += 1
+            with ThreadPoolExecutor(c) as pool:
+                list(pool.map(one, range(n)))
+
+        return self._measure(name, n, run)
+
+    def photo(self):
+        if self._photo is None:
+            from PIL import Image
+            buf = io.BytesIO()
+            Image.new('RGB', (1600, 1200), (120, 140, 160)).save(buf, 'JPEG', quality=90)
+            self._photo = buf.getvalue()
+        return self._photo
+
+    def experts_list(self):
+        def request(client, i):
+            city = CITIES[i % len(CITIES)]
+            return client.get(f"/consultation-experts?city={city}&limit=50&has_free_slots=1",
+                              headers={'Accept-Encoding': 'gzip'})
+        return self._http('experts_list', request)
+
+    def book_expert(self):
+        def request(client, i):
+            slot = date.today() + timedelta(days=1 + i % 14)
+            return client.post('/book-expert', json={
+                'fio': f'Клиент {i}', 'expert_name': f'Эксперт {i % self.args.experts}',
+                'date': slot.strftime('%d.%m.%y'), 'time': f'{8 + i % 15:02d}:00',
+            })
+        return self._http('book_expert', request)
+
+    def register_user(self):
+        return self._http('register_user', lambda client, i: client.post(
+            '/register-user', json={'name': f'Пользователь {i}', 'city': CITIES[i % len(CITIES)]}))
+
+    def register_expert(self):
+        jobs = []
+
+        def request(client, i):
+            resp = client.post('/register-expert', data={
+                'fio': f'Новый эксперт {i}', 'city': CITIES[i % len(CITIES)],
+                'sphere': SPHERES[i % len(SPHERES)], 'description': 'Описание',
+                'photo': (io.BytesIO(self.photo()), f'photo{i}.jpg'),
+            }, content_type='multipart/form-data')
+            if resp.status_code == 202:
+                jobs.append(resp.get_json()['job_id'])
+            return resp
+
+        def wait_jobs():
+            # загрузка в Drive идёт в фоне: ждём её, чтобы учесть вызовы Drive и неудачи
+            deadline = time.time() + 300
+            while time.time() < deadline:
+                states = [self.server.photo_queue.status(j)['state'] for j in jobs]
+                if all(s in ('done', 'failed') for s in states):
+                    return states.count('failed')
+                time.sleep(0.05)
+            return len(jobs)
+
+        row = self._http('register_expert', request)
+        before = self._snapshot()
+        row['errors'] += wait_jobs()
+        self.server.repo.flush()
+        after = self._snapshot()
+        for k in after:
+            row['calls'][k] = round(row['calls'][k] + (after[k] - before[k]) / self.args.requests, 2)
+        return row
+
+    # --- Диалоги бота ---
+    def _update(self, user_id, text=None, data=None, photo=False):
+        from telegram import Update
+        self._update_id = getattr(self, '_update_id', 0) + 1
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}', 'username': f'u{user_id}'}
+        chat = {'id': user_id, 'type': 'private'}
+        if data is not None:
+            payload = {'callback_query': {
+                'id': str(self._update_id), 'from': user, 'chat_instance': str(user_id), 'data': data,
+                'message': {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': '-'},
+            }}
+        else:
+            message = {'message_id': self._update_id, 'date': int(time.time()), 'chat': chat, 'from': user}
+            if photo:
+                message['photo'] = [{'file_id': f'photo{user_id}', 'file_unique_id': f'p{user_id}',
+                                     'width': 100, 'height': 100}]
+            else:
+                message['text'] = text
+                if text.startswith('/'):
+                    message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+            payload = {'message': message}
+        payload['update_id'] = self._update_id
+        return Update.de_json(payload, self.bot.application.bot)
+
+    def _buttons(self, user_id):
+        markup = self.fakes.bot_api.markups.get(user_id) or {}
+        return [b['callback_data'] for row in markup.get('inline_keyboard', []) for b in row]
+
+    async def _press(self, user_id, pick):
+        """Нажимает кнопку последней клавиатуры чата: pick(callback_data-список) -> data."""
+        data = pick(self._buttons(user_id))
+        await self.bot.application.process_update(self._update(user_id, data=data))
+
+    async def flow_consult(self, user_id, rnd):
+        app = self.bot.application
+        await app.process_update(self._update(user_id, data='need_consult'))
+        for prefix in ('region_', 'field_', 'spec_', 'date_', 'time_'):
+            await self._press(user_id, lambda bs: rnd.choice([b for b in bs if b.startswith(prefix)]))
+
+    async def flow_slots(self, user_id, rnd):
+        import slot_picker
+        app = self.bot.application
+        await app.process_update(self._update(user_id, text='/time'))
+        # повторное нажатие снимает отметку, поэтому кнопки выбираются разные
+        for i in rnd.sample(range(slot_picker.DATES_AHEAD), 2):
+            await self._press(user_id, lambda bs: [b for b in bs if b.startswith('t:d')][i])
+        await self._press(user_id, lambda bs: next(b for b in bs if b.startswith('t:D')))
+        for i in rnd.sample(range(len(slot_picker.HOURS)), 3):
+            await self._press(user_id, lambda bs: [b for b in bs if b.startswith('t:h')][i])
+        await self._press(user_id, lambda bs: next(b for b in bs if b.startswith('t:C')))
+
+    async def flow_register(self, user_id, rnd):
+        app = self.bot.application
+        await app.process_update(self._update(user_id, data='register_expert'))
+        for text in (f'Эксперт {user_id}', rnd.choice(CITIES), rnd.choice(SPHERES), 'Описание'):
+            await app.process_update(self._update(user_id, text=text))
+        await app.process_update(self._update(user_id, photo=True))
+
+    def _bot(self, name, flow, user_ids):
+        n, c = self.args.requests, self.args.concurrency
+
+        def run(result):
+            started = time.perf_counter()
+            errors = self.handler_errors
+
+            async def main():
+                sem = asyncio.Semaphore(c)
+
+                async def one(i):
+                    async with sem:
+                        rnd = random.Random(self.args.seed + i)
+                        t0 = time.perf_counter()
+                        try:
+                            await flow(user_ids(i), rnd)
+                        except Exception:
+                            result.errors += 1
+                        result.latencies.append(time.perf_counter() - t0)
+
+                await asyncio.gather(*(one(i) for i in range(n)))
+                result.elapsed = time.perf_counter() - started
+                # уведомления уходят в фоне — дожидаемся очереди, чтобы учесть их вызовы
+                while self.bot.notifier.qsize():
+                    await asyncio.sleep(0.01)
+
+            self.loop.run_until_complete(main())
+            # ошибки обработчиков PTB перехватывает сам и передаёт в error handler
+            result.errors += self.handler_errors - errors
+
+        return self._measure(name, n, run)
+
+    def bot_consult(self):
+        row = self._bot('bot_consult', self.flow_consult, lambda i: FIRST_CLIENT_ID + i)
+        return self._check_bookings(row)
+
+    def _check_bookings(self, row):
+        """Инварианты записи через бота: слот не достаётся двоим и пропадает из Slots эксперта.
+
+        Нарушения добавляются к ошибкам и печатаются отдельно.
+        """
+        from datetime import datetime
+        from ledger import SLOT_KEY
+        seen, violations = set(), 0
+        for booking in self.bot.repo.bookings.iter():
+            if booking['source'] != 'bot':
+                continue
+            key = (booking['expert_id'], booking['slot'])
+            slot = datetime.strptime(booking['slot'], SLOT_KEY)
+            if key in seen or slot in self.bot.experts.slots_of(booking['expert_id']):
+                violations += 1
+            seen.add(key)
+        row['violations'] = violations
+        row['errors'] += violations
+        if violations:
+            print(f"  bot_consult: нарушений записи — {violations}", file=sys.stderr)
+        return row
+
+    def bot_slots(self):
+        return self._bot('bot_slots', self.flow_slots, lambda i: FIRST_EXPERT_ID + i % self.args.experts)
+
+    def bot_register(self):
+        return self._bot('bot_register', self.flow_register, lambda i: FIRST_CLIENT_ID + 100000 + i)
+
+    # --- Запуск ---
+    HTTP = ['experts_list', 'book_expert', 'register_user', 'register_expert']
+    BOT = ['bot_consult', 'bot_slots', 'bot_register']
+
+    def run(self, names):
+        rows = []
+        self.server.start_background()
+        self.loop = asyncio.new_event_loop()
+        app = self.bot.application
+        self.loop.run_until_complete(app.initialize())
+        self.loop.run_until_complete(app.start())
+        self.loop.run_until_complete(self._start_notifier())
+        try:
+            for name in names:
+                rows.append(getattr(self, name)())
+                print_row(rows[-1])
+        finally:
+            self.loop.run_until_complete(self.bot.notifier.stop())
+            self.loop.run_until_complete(app.stop())
+            self.loop.run_until_complete(app.shutdown())
+        return rows
+
+    async def _start_notifier(self):
+        self.bot.notifier.start()
+        await self.bot.reminders.load()
+
+
+def print_row(row):
+    calls = ' '.join(f"{k}={v}" for k, v in row['calls'].items())
+    print(f"{row['operation']:<16} {row['ops']:>6} {row['errors']:>6} {row['ops_per_sec']:>9} "
+          f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}  {calls}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--requests', type=int, default=200, help='операций на сценарий')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='одновременных операций')
+    parser.add_argument('--experts', type=int, default=300, help='экспертов в таблице')
+    parser.add_argument('--backend', choices=['sheets', 'sqlite'], default='sheets')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа API, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='разброс задержки, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503/502')
+    parser.add_argument('--quota-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--sheets-rpm', type=int, default=60000,
+                        help='квота Sheets в минуту (0 — как в настройках процесса)')
+    parser.add_argument('--drive-rpm', type=int, default=60000,
+                        help='квота Drive в минуту (0 — как в настройках процесса)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', help='сценарии через запятую: ' + ','.join(Bench.HTTP + Bench.BOT))
+    parser.add_argument('--json', help='сохранить результаты в файл')
+    parser.add_argument('-v', '--verbose', action='store_true', help='показывать логи приложения')
+    args = parser.parse_args(argv)
+
+    names = args.only.split(',') if args.only else Bench.HTTP + Bench.BOT
+    unknown = set(names) - set(Bench.HTTP + Bench.BOT)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    bench = Bench(args)
+    if not args.verbose:
+        # ошибки и так считаются в таблице; при --error-rate логи забивают вывод
+        logging.disable(logging.CRITICAL)
+    print(f"{'operation':<16} {'ops':>6} {'errors':>6} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  "
+          f"API calls per op")
+    rows = bench.run(names)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': rows}, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,9 @@
 import os
-import json
 import logging
-import gspread
-import threading
-from google.oauth2.service_account import Credentials
-from flask import Flask
+import signal
+import secrets
+import asyncio
+from tornado.httpserver import HTTPServer
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup
 )
@@ -12,75 +11,40 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
     ConversationHandler, ContextTypes, filters
 )
-from datetime import datetime, timedelta
+from datetime import datetime
+from storage import open_repository
+from slots import BOOKED, TAKEN, DATE_FORMAT, TIME_FORMAT, parse_date, parse_slot
+import slot_picker
+import sheets_io
+from webhook import UpdateDispatcher, TelegramRequest, instrument_handlers, make_app
+from notify import Notifier, Reminders
+from sessions import Session, SessionPersistence, SESSION_TTL
 
 logging.basicConfig(level=logging.INFO)
 TOKEN      = os.environ['TELEGRAM_TOKEN']
-SHEET_ID   = os.environ['SHEET_ID']
-CREDS_JSON = json.loads(os.environ['GSPREAD_CREDENTIALS_JSON'])
 PORT       = int(os.environ.get('PORT', '8080'))
-
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-creds = Credentials.from_service_account_info(CREDS_JSON, scopes=SCOPES)
-gc = gspread.authorize(creds)
-sheet = gc.open_by_key(SHEET_ID)
-ws_experts = sheet.worksheet('Эксперты')
-ws_users   = sheet.worksheet('Users')
-ws_orders  = sheet.worksheet('Заявки')
+# 0 — обновления обрабатываются по одному, N > 0 — до N одновременно
+CONCURRENT_UPDATES = int(os.environ.get('BOT_CONCURRENT_UPDATES', '0'))
+# Если задан публичный адрес, бот получает обновления вебхуком, иначе — polling
+WEBHOOK_URL    = os.environ.get('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH   = os.environ.get('WEBHOOK_PATH', '/telegram')
+# Без секрета кто угодно, узнав адрес, мог бы слать поддельные обновления от любого
+# пользователя; если WEBHOOK_SECRET не задан, он генерируется при запуске и
+# передаётся в set_webhook
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or (secrets.token_urlsafe(32) if WEBHOOK_URL else None)
+
+# Хранилище выбирается STORAGE_BACKEND; листы Google открываются при первом обращении,
+# ключ и ID таблицы — в GSPREAD_CREDENTIALS_JSON и SHEET_ID
+repo = open_repository()
+experts = repo.experts
+repo.start()
 
 # --- Работаем ТОЛЬКО через Telegram ID ---
-def get_specialist_row_by_id(telegram_id):
-    records = ws_experts.get_all_records()
-    for i, row in enumerate(records, 2):  # 2 — из-за заголовка
-        if str(row.get('Telegram ID')) == str(telegram_id):
-            return ws_experts, i, row
-    return None, None, None
-
 def remove_slot_for_specialist_by_id(telegram_id, date, time):
-    ws, row_num, row = get_specialist_row_by_id(telegram_id)
-    if not row_num:
-        return False
-    cur_slots = ws.cell(row_num, 8).value or ''
-    cur_list = [s.strip() for s in cur_slots.split(';') if s.strip()]
-    slot = f"{date} {time}"
-    if slot in cur_list:
-        cur_list.remove(slot)
-    ws.update_cell(row_num, 8, ';'.join(cur_list))
-    return True
-
-def add_slots_for_specialist_by_id(telegram_id, date, times):
-    ws, row_num, _ = get_specialist_row_by_id(telegram_id)
-    if not row_num:
-        return False
-    cur_slots = ws.cell(row_num, 8).value or ''
-    cur_list = [s.strip() for s in cur_slots.split(';') if s.strip()]
-    for t in times:
-        slot = f"{date} {t}"
-        if slot not in cur_list:
-            cur_list.append(slot)
-    ws.update_cell(row_num, 8, ';'.join(sorted(cur_list)))
-    return True
+    return repo.book_slot(telegram_id, date, time)
 
 REG_NAME, REG_CITY, REG_FIELD, REG_DESC, REG_PHOTO = range(5)
 SELECT_REGION, SELECT_FIELD, SELECT_SPEC, SELECT_DATE, SELECT_TIME = range(5)
-TIME_DATE, TIME_SELECT = range(2)
-
-def get_specialists():
-    records = ws_experts.get_all_records()
-    specialists = []
-    for i, row in enumerate(records, 2):
-        spec = dict(row)
-        spec['row_num'] = i
-        slots = []
-        slots_str = row.get('Slots', '')
-        if slots_str:
-            for el in slots_str.split(';'):
-                el = el.strip()
-                if el and ' ' in el:
-                    slots.append(el)
-        spec['slots'] = slots
-        specialists.append(spec)
-    return specialists
 
 async def fallback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.message:
@@ -109,32 +73,32 @@ async def cb_register_expert(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     return REG_NAME
 
 async def reg_name(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    ctx.user_data['fio'] = update.message.text
+    ctx.user_data.fio = update.message.text
     await update.message.reply_text("Введите ваш город:")
     return REG_CITY
 
 async def reg_city(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    ctx.user_data['city'] = update.message.text
+    ctx.user_data.city = update.message.text
     await update.message.reply_text("Введите сферу деятельности:")
     return REG_FIELD
 
 async def reg_field(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    ctx.user_data['field'] = update.message.text
+    ctx.user_data.field = update.message.text
     await update.message.reply_text("Кратко опишите себя:")
     return REG_DESC
 
 async def reg_desc(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    ctx.user_data['desc'] = update.message.text
+    ctx.user_data.desc = update.message.text
     await update.message.reply_text("Пришлите фото сертификата или любой документ:")
     return REG_PHOTO
 
 async def reg_photo(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     file_id = update.message.photo[-1].file_id if update.message.photo else ''
-    ws_experts.append_row([
-        ctx.user_data['fio'],
-        ctx.user_data['city'],
-        ctx.user_data['field'],
-        ctx.user_data['desc'],
+    await sheets_io.run(repo.append, 'experts', [
+        ctx.user_data.fio,
+        ctx.user_data.city,
+        ctx.user_data.field,
+        ctx.user_data.desc,
         file_id,
         update.effective_user.id,
         update.effective_user.username or '',
@@ -152,123 +116,195 @@ async def reg_cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # --- ВЫБОР СЛОТОВ С ГАЛОЧКАМИ ---
-def build_time_keyboard(times, selected):
-    kb = []
-    for t in times:
-        label = f"✅ {t}" if t in selected else t
-        kb.append([InlineKeyboardButton(label, callback_data=f"time_select_{t}")])
-    kb.append([InlineKeyboardButton("Подтвердить", callback_data="time_confirm")])
-    kb.append([InlineKeyboardButton("⬅️ Назад", callback_data="time_back")])
-    return InlineKeyboardMarkup(kb)
+# Можно отметить несколько дат сразу или задать недельный шаблон;
+# всё выбранное записывается в слоты эксперта одной операцией.
+# Выбор хранится в самих кнопках (slot_picker), а не в сессии.
+DATE_PROMPT = "Выберите одну или несколько дат для добавления слотов:"
+
+async def send_date_keyboard(message):
+    await message.reply_text(DATE_PROMPT, reply_markup=slot_picker.date_keyboard(slot_picker.PickerState.new()))
 
 async def cb_add_time(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
-    today = datetime.now()
-    dates = [(today + timedelta(days=i)).strftime("%d.%m.%y") for i in range(7)]
-    kb = [[InlineKeyboardButton(date, callback_data=f"time_date_{date}")] for date in dates]
-    await update.callback_query.message.reply_text(
-        "Выберите дату для добавления слотов:",
-        reply_markup=InlineKeyboardMarkup(kb)
-    )
-    return TIME_DATE
+    await send_date_keyboard(update.callback_query.message)
 
 async def add_time_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    today = datetime.now()
-    dates = [(today + timedelta(days=i)).strftime("%d.%m.%y") for i in range(7)]
-    kb = [[InlineKeyboardButton(date, callback_data=f"time_date_{date}")] for date in dates]
-    await update.message.reply_text(
-        "Выберите дату для добавления слотов:",
-        reply_markup=InlineKeyboardMarkup(kb)
+    await send_date_keyboard(update.message)
+
+async def time_date(query, state, i):
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=slot_picker.date_keyboard(state.toggle('dates', i)))
+
+async def time_dates_done(query, state, _):
+    if not state.dates:
+        await query.answer("Отметьте хотя бы одну дату", show_alert=True)
+        return
+    await query.answer()
+    await query.message.reply_text(
+        f"Выберите время для {slot_picker.date_labels(state)}:",
+        reply_markup=slot_picker.hour_keyboard(state._replace(weekdays=0, hours=0))
     )
-    return TIME_DATE
 
-async def time_date(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    date = update.callback_query.data.split('_', 2)[2]
-    ctx.user_data['selected_date'] = date
-    times = [f"{str(h).zfill(2)}:00" for h in range(8, 23)]
-    ctx.user_data['selected_times'] = []
-    kb = build_time_keyboard(times, ctx.user_data['selected_times'])
-    await update.callback_query.message.reply_text(
-        f"Выберите время для {date}:",
-        reply_markup=kb
+async def time_template(query, state, _):
+    await query.answer()
+    await query.message.reply_text(
+        "Выберите дни недели:",
+        reply_markup=slot_picker.weekday_keyboard(state._replace(weekdays=0, hours=0))
     )
-    return TIME_SELECT
 
-async def time_select(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    time = update.callback_query.data.split('_', 2)[2]
-    selected_times = ctx.user_data.get('selected_times', [])
-    if time in selected_times:
-        selected_times.remove(time)
+async def time_weekday(query, state, i):
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=slot_picker.weekday_keyboard(state.toggle('weekdays', i)))
+
+async def time_weekdays_done(query, state, _):
+    if not state.weekdays:
+        await query.answer("Отметьте хотя бы один день", show_alert=True)
+        return
+    await query.answer()
+    await query.message.reply_text(
+        f"Выберите время для: {slot_picker.weekday_labels(state)}",
+        reply_markup=slot_picker.hour_keyboard(state._replace(hours=0))
+    )
+
+async def time_select(query, state, i):
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=slot_picker.hour_keyboard(state.toggle('hours', i)))
+
+async def time_back(query, state, _):
+    await query.answer()
+    await query.message.edit_text(
+        DATE_PROMPT,
+        reply_markup=slot_picker.date_keyboard(state._replace(weekdays=0, hours=0))
+    )
+
+async def save_slots(query, slots, summary):
+    # слоты в прошлом (кнопки могли быть нажаты через несколько дней) не добавляем
+    now = datetime.now()
+    slots = [slot for slot in slots if slot > now]
+    ok = await sheets_io.run(repo.add_slots, query.from_user.id, slots)
+    if not ok:
+        await query.message.reply_text("Сначала зарегистрируйтесь как эксперт.")
     else:
-        selected_times.append(time)
-    ctx.user_data['selected_times'] = selected_times
-    times = [f"{str(h).zfill(2)}:00" for h in range(8, 23)]
-    kb = build_time_keyboard(times, selected_times)
-    await update.callback_query.edit_message_reply_markup(reply_markup=kb)
-    return TIME_SELECT
-
-async def time_back(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    today = datetime.now()
-    dates = [(today + timedelta(days=i)).strftime("%d.%m.%y") for i in range(7)]
-    kb = [[InlineKeyboardButton(date, callback_data=f"time_date_{date}")] for date in dates]
-    await update.callback_query.message.edit_text(
-        "Выберите дату для добавления слотов:",
-        reply_markup=InlineKeyboardMarkup(kb)
+        await query.message.reply_text(summary.format(count=len(slots)))
+
+async def time_confirm(query, state, _):
+    await query.answer()
+    times = state.selected_hours()
+    if not times or not (state.dates or state.weekdays):
+        await query.message.reply_text("Выберите дату и время!")
+        return
+    if state.weekdays:
+        # недельный шаблон: осталось выбрать, на сколько недель
+        await query.message.reply_text(
+            "На сколько недель вперёд повторить?",
+            reply_markup=slot_picker.weeks_keyboard(state)
+        )
+        return
+    await save_slots(
+        query, state.slots(),
+        f"Время для {slot_picker.date_labels(state)} добавлено: {', '.join(times)}"
     )
-    return TIME_DATE
 
-async def time_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    date = ctx.user_data.get('selected_date')
-    times = ctx.user_data.get('selected_times', [])
-    telegram_id = update.effective_user.id
-    if not date or not times:
-        await update.callback_query.message.reply_text("Выберите дату и время!")
-        return ConversationHandler.END
-    add_slots_for_specialist_by_id(telegram_id, date, times)
-    await update.callback_query.message.reply_text(
-        f"Время для {date} добавлено: {', '.join(times)}"
+async def time_weeks(query, state, weeks):
+    await query.answer()
+    if weeks not in slot_picker.TEMPLATE_WEEKS or not state.weekdays:
+        return
+    times = ', '.join(state.selected_hours())
+    await save_slots(
+        query, state.slots(weeks),
+        f"Добавлено {{count}} слотов: {slot_picker.weekday_labels(state)}, {times} на {weeks} нед."
     )
-    return ConversationHandler.END
+
+async def time_clear_dates(query, state, _):
+    if not state.dates:
+        await query.answer("Отметьте даты, которые нужно очистить", show_alert=True)
+        return
+    await query.answer()
+    gone = await sheets_io.run(repo.clear_slots, query.from_user.id, state.selected_dates())
+    if gone is None:
+        await query.message.reply_text("Сначала зарегистрируйтесь как эксперт.")
+    else:
+        await query.message.reply_text(f"Удалено слотов: {gone} ({slot_picker.date_labels(state)})")
+
+PICKER_ACTIONS = {
+    'd': time_date,
+    'D': time_dates_done,
+    'T': time_template,
+    'w': time_weekday,
+    'W': time_weekdays_done,
+    'h': time_select,
+    'B': time_back,
+    'C': time_confirm,
+    'n': time_weeks,
+    'X': time_clear_dates,
+}
+
+async def cb_picker(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        action, arg, state = slot_picker.decode(query.data)
+        handler = PICKER_ACTIONS[action]
+    except (ValueError, KeyError):
+        await query.answer("Кнопка устарела, начните заново: /time", show_alert=True)
+        return
+    await handler(query, state, arg)
+
+# --- Очистка всех слотов эксперта ---
+async def clear_slots_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    kb = [[
+        InlineKeyboardButton("Да, удалить", callback_data="clear_all_yes"),
+        InlineKeyboardButton("Отмена", callback_data="clear_all_no"),
+    ]]
+    await update.message.reply_text("Удалить все ваши свободные слоты?", reply_markup=InlineKeyboardMarkup(kb))
+
+async def cb_clear_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    if update.callback_query.data != "clear_all_yes":
+        await update.callback_query.message.edit_text("Слоты не изменены.")
+        return
+    gone = await sheets_io.run(repo.clear_slots, update.effective_user.id)
+    if gone is None:
+        await update.callback_query.message.edit_text("Вы не зарегистрированы как эксперт.")
+    else:
+        await update.callback_query.message.edit_text(f"Удалено слотов: {gone}")
 
 # --- Блок консультаций (запись пользователя) ---
 async def cb_need_consult(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
-    specialists = get_specialists()
-    ctx.user_data['specialists'] = specialists
-    regions = sorted(set([spec['Город'] for spec in specialists if spec['Город']]))
+    facets = await sheets_io.run(experts.facets)
+    regions = facets.cities()
     kb = [[InlineKeyboardButton(region, callback_data=f"region_{region}")] for region in regions]
     await update.callback_query.message.reply_text("Выберите регион:", reply_markup=InlineKeyboardMarkup(kb))
     return SELECT_REGION
 
 async def cb_region(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     region = update.callback_query.data.split('_', 1)[1]
-    specialists = ctx.user_data['specialists']
-    fields = sorted(set([spec['сфера'] for spec in specialists if spec['Город'] == region and spec['сфера']]))
-    ctx.user_data['selected_region'] = region
+    facets = await sheets_io.run(experts.facets)
+    fields = facets.spheres(region)
+    ctx.user_data.selected_region = region
     kb = [[InlineKeyboardButton(field, callback_data=f"field_{field}")] for field in fields]
     await update.callback_query.message.reply_text(f"Регион: {region}\nВыберите сферу:", reply_markup=InlineKeyboardMarkup(kb))
     return SELECT_FIELD
 
 async def cb_field(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     field = update.callback_query.data.split('_', 1)[1]
-    region = ctx.user_data['selected_region']
-    specs = [s for s in ctx.user_data['specialists'] if s['Город'] == region and s['сфера'] == field]
-    ctx.user_data['selected_field'] = field
-    kb = [[InlineKeyboardButton(spec['ФИО эксперта'], callback_data=f"spec_{spec['row_num']}")] for spec in specs]
+    region = ctx.user_data.selected_region
+    facets = await sheets_io.run(experts.facets)
+    ctx.user_data.selected_field = field
+    kb = [
+        [InlineKeyboardButton(facets.names[tg], callback_data=f"spec_{tg}")]
+        for tg in facets.experts(region, field)
+    ]
     await update.callback_query.message.reply_text(f"Сфера: {field}\nВыберите специалиста:", reply_markup=InlineKeyboardMarkup(kb))
-    ctx.user_data['filtered_specs'] = {str(spec["row_num"]): spec for spec in specs}
     return SELECT_SPEC
 
 async def cb_spec(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    spec_row = update.callback_query.data.split('_', 1)[1]
-    spec = ctx.user_data['filtered_specs'][spec_row]
-    ctx.user_data['selected_specialist'] = spec
-    ctx.user_data['expert_telegram_id'] = spec['Telegram ID']
-    ctx.user_data['fio_expert'] = spec['ФИО эксперта']
+    telegram_id = update.callback_query.data.split('_', 1)[1]
+    row_num, spec = await sheets_io.run(experts.find, telegram_id)
+    if row_num is None:
+        await update.callback_query.message.reply_text("Специалист не найден.")
+        return ConversationHandler.END
+    ctx.user_data.expert_telegram_id = spec['Telegram ID']
     text = f"{spec['ФИО эксперта']}\n{spec.get('описание','')}"
     if spec.get('photo_file_id'):
         await update.callback_query.message.reply_photo(
@@ -277,45 +313,68 @@ async def cb_spec(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
     else:
         await update.callback_query.message.reply_text(text)
-    dates = sorted(set([slot.split()[0] for slot in spec['slots']]))
+    dates = [day.strftime(DATE_FORMAT) for day in experts.slot_index(row_num).dates()]
     kb = [[InlineKeyboardButton(date, callback_data=f"date_{date}")] for date in dates]
     await update.callback_query.message.reply_text("Выберите дату:", reply_markup=InlineKeyboardMarkup(kb))
-    ctx.user_data['slots_of_expert'] = spec['slots']
     return SELECT_DATE
 
 async def cb_date(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     date = update.callback_query.data.split('_', 1)[1]
-    times = [slot.split()[1] for slot in ctx.user_data['slots_of_expert'] if slot.startswith(date)]
+    slots = await sheets_io.run(experts.slots_of, ctx.user_data.expert_telegram_id)
+    times = [dt.strftime(TIME_FORMAT) for dt in slots.on_date(parse_date(date))]
     kb = [[InlineKeyboardButton(time, callback_data=f"time_{time}")] for time in times]
     await update.callback_query.message.reply_text(f"Выберите время для {date}:", reply_markup=InlineKeyboardMarkup(kb))
-    ctx.user_data['selected_date'] = date
+    ctx.user_data.selected_date = date
     return SELECT_TIME
 
 async def cb_time(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     time = update.callback_query.data.split('_', 1)[1]
-    date = ctx.user_data['selected_date']
-    expert_telegram_id = ctx.user_data.get('expert_telegram_id')
-    remove_slot_for_specialist_by_id(expert_telegram_id, date, time)
-    await update.callback_query.message.reply_text(f"Вы записались к специалисту на {date} в {time}.")
-    # --- Уведомление эксперту ---
-    if expert_telegram_id:
-        text = (
-            f"На ваш слот записался пользователь!\n\n"
-            f"Дата: {date}\nВремя: {time}\n"
-            f"Пользователь: @{update.effective_user.username or update.effective_user.full_name}"
+    date = ctx.user_data.selected_date
+    expert_telegram_id = ctx.user_data.expert_telegram_id
+    result = await sheets_io.run(remove_slot_for_specialist_by_id, expert_telegram_id, date, time)
+    if result == TAKEN:
+        # слот успели занять — показываем, что осталось на эту дату
+        slots = await sheets_io.run(experts.slots_of, expert_telegram_id)
+        times = [dt.strftime(TIME_FORMAT) for dt in slots.on_date(parse_date(date))]
+        if not times:
+            await update.callback_query.message.reply_text(f"Свободного времени на {date} больше нет.")
+            return ConversationHandler.END
+        kb = [[InlineKeyboardButton(t, callback_data=f"time_{t}")] for t in times]
+        await update.callback_query.message.reply_text(
+            f"Время {time} уже занято. Выберите другое время для {date}:",
+            reply_markup=InlineKeyboardMarkup(kb)
         )
-        await ctx.bot.send_message(chat_id=expert_telegram_id, text=text)
+        return SELECT_TIME
+    if result != BOOKED:
+        await update.callback_query.message.reply_text("Специалист не найден.")
+        return ConversationHandler.END
+    await update.callback_query.message.reply_text(f"Вы записались к специалисту на {date} в {time}.")
+    client = update.effective_user.username or update.effective_user.full_name
+    slot = parse_slot(date, time)
+    _, spec = await sheets_io.run(experts.find, expert_telegram_id)
+    expert_name = spec['ФИО эксперта'] if spec else ''
+    await sheets_io.run(
+        repo.record_booking, slot,
+        expert_id=expert_telegram_id, expert_name=expert_name,
+        client_id=update.effective_user.id, client_name=update.effective_user.full_name, source='bot',
+    )
+    # --- Уведомление эксперту и напоминания обоим: отправляются в фоне ---
+    notifier.send(expert_telegram_id, (
+        f"На ваш слот записался пользователь!\n\n"
+        f"Дата: {date}\nВремя: {time}\n"
+        f"Пользователь: @{client}"
+    ))
+    await reminders.add(slot, [
+        (expert_telegram_id, f"Напоминание: консультация {date} в {time}, пользователь @{client}."),
+        (update.effective_user.id, f"Напоминание: консультация у {expert_name or 'специалиста'} {date} в {time}."),
+    ])
     return ConversationHandler.END
 
-# --- Flask health-check ---
-app = Flask(__name__)
-
-@app.route("/", methods=["GET", "HEAD"])
-def health():
-    return "OK", 200
-
 # --- Handlers ---
 reg_conv = ConversationHandler(
+    name="reg_conv",
+    persistent=True,
+    conversation_timeout=SESSION_TTL,
     entry_points=[CallbackQueryHandler(cb_register_expert, pattern="register_expert")],
     states={
         REG_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_name)],
@@ -331,6 +390,9 @@ reg_conv = ConversationHandler(
 )
 
 consult_conv = ConversationHandler(
+    name="consult_conv",
+    persistent=True,
+    conversation_timeout=SESSION_TTL,
     entry_points=[CallbackQueryHandler(cb_need_consult, pattern="need_consult")],
     states={
         SELECT_REGION: [CallbackQueryHandler(cb_region, pattern=r"^region_")],
@@ -345,29 +407,64 @@ consult_conv = ConversationHandler(
     ],
 )
 
-time_conv = ConversationHandler(
-    entry_points=[
-        CallbackQueryHandler(cb_add_time, pattern="add_time"),
-        CommandHandler("time", cb_add_time),   # <-- Вот так!
-    ],
-    states={
-        TIME_DATE: [CallbackQueryHandler(time_date, pattern=r"^time_date_")],
-        TIME_SELECT: [
-            CallbackQueryHandler(time_select, pattern=r"^time_select_"),
-            CallbackQueryHandler(time_confirm, pattern="time_confirm"),
-            CallbackQueryHandler(time_back, pattern="time_back"),
-        ]
-    },
-    fallbacks=[CommandHandler("cancel", fallback)],
+# Состояние диалогов (ctx.user_data — Session) сохраняется в SQLite и переживает перезапуск
+persistence = SessionPersistence()
+application = (
+    ApplicationBuilder()
+    .token(TOKEN)
+    # вызовы Bot API учитываются в metrics (GET /metrics)
+    .request(TelegramRequest(connection_pool_size=256))
+    .get_updates_request(TelegramRequest())
+    .concurrent_updates(CONCURRENT_UPDATES or False)
+    .persistence(persistence)
+    .context_types(ContextTypes(user_data=Session))
+    .build()
 )
-
-application = ApplicationBuilder().token(TOKEN).build()
+application.job_queue.run_repeating(persistence.expire, interval=3600, first=3600)
+# Исходящие уведомления и напоминания (JobQueue: python-telegram-bot[job-queue])
+notifier = Notifier(application.bot)
+reminders = Reminders(notifier, application.job_queue)
 application.add_handler(CommandHandler("start", start))
-application.add_handler(CommandHandler("time", add_time_cmd))
+application.add_handler(CommandHandler("clear_slots", clear_slots_cmd))
+application.add_handler(CallbackQueryHandler(cb_clear_all, pattern="^clear_all_(yes|no)$"))
 application.add_handler(reg_conv)
 application.add_handler(consult_conv)
-application.add_handler(time_conv)
+application.add_handler(CommandHandler("time", add_time_cmd))
+application.add_handler(CallbackQueryHandler(cb_add_time, pattern="^add_time$"))
+application.add_handler(CallbackQueryHandler(cb_picker, pattern=f"^{slot_picker.PREFIX}"))
+instrument_handlers(application)
+
+# --- Запуск: health-check и вебхук обслуживает один HTTP-сервер ---
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with application:
+        await application.start()
+        notifier.start()
+        await reminders.load()
+        dispatcher = UpdateDispatcher(application) if WEBHOOK_URL else None
+        server = HTTPServer(make_app(dispatcher, WEBHOOK_PATH, WEBHOOK_SECRET))
+        server.listen(PORT, address="0.0.0.0")
+        if dispatcher:
+            dispatcher.start()
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await stop.wait()
+        server.stop()
+        if dispatcher:
+            await dispatcher.stop()
+        else:
+            await application.updater.stop()
+        await notifier.stop()
+        await application.stop()
+    sheets_io.shutdown()
 
 if __name__ == "__main__":
-    threading.Thread(target=app.run, kwargs={"host": "0.0.0.0", "port": PORT}, daemon=True).start()
-    application.run_polling()
+    asyncio.run(main())
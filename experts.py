@@ -0,0 +1,214 @@
+import os
+import re
+import time
+import threading
+from gspread.utils import numericise_all, rowcol_to_a1
+from slots import SlotIndex, SLOTS_COL, TELEGRAM_ID_COL
+
+# Сколько секунд кэш листа «Эксперты» считается свежим
+EXPERTS_TTL = float(os.environ.get('EXPERTS_TTL', '60'))
+
+# Номер первой строки в updatedRange ответа append ('Лист'!A5:H7 -> 5)
+ROW_RE = re.compile(r'![A-Z]+(\d+)')
+
+
+class Facets:
+    """Снимок каталога для выбора эксперта: город → сфера → Telegram ID.
+
+    Эксперты без свободных слотов (или без Telegram ID) в дерево не попадают.
+    """
+
+    __slots__ = ('version', 'minute', 'tree', 'names', 'slot_counts')
+
+    def __init__(self, version, minute, tree, names, slot_counts):
+        self.version = version
+        self.minute = minute
+        self.tree = tree
+        self.names = names
+        self.slot_counts = slot_counts
+
+    def cities(self):
+        return sorted(self.tree)
+
+    def spheres(self, city):
+        return sorted(self.tree.get(city, {}))
+
+    def experts(self, city, sphere):
+        return self.tree.get(city, {}).get(sphere, [])
+
+
+class ExpertDirectory:
+    """Кэш листа «Эксперты» в памяти процесса с индексом Telegram ID → номер строки.
+
+    Лист читается целиком один раз и перечитывается по истечении TTL
+    или после записи, результат которой нельзя применить к кэшу локально.
+    """
+
+    def __init__(self, ws, ttl=EXPERTS_TTL):
+        self.ws = ws
+        self.ttl = ttl
+        self.version = 0
+        self._lock = threading.RLock()
+        self._header = []
+        self._rows = {}       # номер строки -> запись (dict как в get_all_records)
+        self._by_tg = {}      # str(Telegram ID) -> номер строки
+        self._slots = {}      # номер строки -> SlotIndex, разбирается при первом обращении
+        self._facets = None
+        self._loaded_at = None
+
+    # --- Чтение ---
+    def _fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _load(self):
+        data = self.ws.get_all_values()
+        header = data[0] if data else []
+        rows = {}
+        for i, values in enumerate(data[1:], 2):  # 2 — из-за заголовка
+            rows[i] = dict(zip(header, numericise_all(values)))
+        self._fill(header, rows)
+
+    def _fill(self, header, rows):
+        self._header = header
+        self._rows = rows
+        self._by_tg = {}
+        self._slots = {}
+        for i, row in rows.items():
+            self._index(i, row)
+        self._loaded_at = time.monotonic()
+        self.version += 1
+
+    def _index(self, row_num, row):
+        tg = str(row.get('Telegram ID', '')).strip()
+        if tg:
+            self._by_tg[tg] = row_num
+
+    def _ensure(self):
+        if not self._fresh():
+            self._load()
+
+    def current_version(self):
+        """Версия данных после проверки TTL: меняется при каждой перезагрузке или записи."""
+        with self._lock:
+            self._ensure()
+            return self.version
+
+    def rows(self):
+        """Пары (номер строки, запись) в порядке строк."""
+        with self._lock:
+            self._ensure()
+            return [(i, dict(row)) for i, row in sorted(self._rows.items())]
+
+    def find(self, telegram_id):
+        """Номер строки и запись эксперта по Telegram ID за O(1)."""
+        with self._lock:
+            self._ensure()
+            row_num = self._by_tg.get(str(telegram_id))
+            if row_num is None:
+                return None, None
+            return row_num, dict(self._rows[row_num])
+
+    def slot_index(self, row_num):
+        """Разобранные слоты строки без прошедших. Индекс общий — не изменять."""
+        with self._lock:
+            index = self._slots.get(row_num)
+            if index is None:
+                row = self._rows.get(row_num, {})
+                index = self._slots[row_num] = SlotIndex.parse(row.get('Slots'))
+            index.prune()
+            return index
+
+    def slots_of(self, telegram_id):
+        """Слоты эксперта по Telegram ID (пустой индекс, если эксперта нет)."""
+        row_num, _ = self.find(telegram_id)
+        if row_num is None:
+            return SlotIndex()
+        return self.slot_index(row_num)
+
+    def facets(self):
+        """Общий для всех диалогов индекс город → сфера → эксперты.
+
+        Пересобирается при смене версии и раз в минуту: слоты истекают
+        без записи, и эксперт без будущих слотов должен пропасть из списка.
+        """
+        minute = int(time.time() // 60)
+        with self._lock:
+            self._ensure()
+            facets = self._facets
+            if facets is not None and facets.version == self.version and facets.minute == minute:
+                return facets
+            tree, names, counts = {}, {}, {}
+            for row_num, row in sorted(self._rows.items()):
+                tg = str(row.get('Telegram ID', '')).strip()
+                city, sphere = row.get('Город'), row.get('сфера')
+                if not (tg and city and sphere):
+                    continue
+                count = len(self.slot_index(row_num))
+                if not count:
+                    continue
+                tree.setdefault(str(city), {}).setdefault(str(sphere), []).append(tg)
+                names[tg] = row.get('ФИО эксперта', '')
+                counts[tg] = count
+            self._facets = Facets(self.version, minute, tree, names, counts)
+            return self._facets
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def read_slots(self, row_num, telegram_id):
+        """Ячейка Slots строки прямо из листа, если строка всё ещё принадлежит эксперту.
+
+        Telegram ID и Slots читаются одним запросом: люди могут вставлять,
+        удалять и сортировать строки, и номер из кэша мог устареть. Если
+        в строке чужой ID, кэш сбрасывается и возвращается None. Чтение
+        не склеивается с уже идущим (key=None): тот мог начаться до
+        последней записи.
+        """
+        rng = f"{rowcol_to_a1(row_num, TELEGRAM_ID_COL)}:{rowcol_to_a1(row_num, SLOTS_COL)}"
+        values = list((self.ws.get(rng, key=None) or [[]])[0])
+        values += [''] * (SLOTS_COL - TELEGRAM_ID_COL + 1 - len(values))
+        if str(values[0]).strip() != str(telegram_id):
+            self.invalidate()
+            return None
+        value = values[-1] or ''
+        self._patch(row_num, SLOTS_COL, value)
+        return value
+
+    # --- Запись со сквозным обновлением кэша ---
+    def update_cell(self, row_num, col, value):
+        self.ws.update_cell(row_num, col, value)
+        self._patch(row_num, col, value)
+
+    def _patch(self, row_num, col, value):
+        with self._lock:
+            row = self._rows.get(row_num)
+            if row is None or col > len(self._header):
+                self._loaded_at = None
+                return
+            key = self._header[col - 1]
+            if row.get(key) == value:
+                return
+            if key == 'Telegram ID':
+                self._by_tg.pop(str(row.get(key, '')).strip(), None)
+            row[key] = value
+            self._slots.pop(row_num, None)
+            self._index(row_num, row)
+            self.version += 1
+
+    def append_rows(self, rows):
+        res = self.ws.append_rows(rows)
+        updated = (res or {}).get('updates', {}).get('updatedRange', '')
+        m = ROW_RE.search(updated)
+        with self._lock:
+            if not m or not self._header:
+                self._loaded_at = None
+                return res
+            for row_num, values in enumerate(rows, int(m.group(1))):
+                padded = list(values) + [''] * (len(self._header) - len(values))
+                row = dict(zip(self._header, padded))
+                self._rows[row_num] = row
+                self._slots.pop(row_num, None)
+                self._index(row_num, row)
+            self.version += 1
+        return res
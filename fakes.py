@@ -0,0 +1,417 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import Counter
+from email.parser import BytesParser
+from urllib.parse import unquote, urlsplit
+import httplib2
+import requests
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+
+# Локальные заменители Google Sheets, Google Drive и Telegram Bot API.
+# Подменяют только транспорт: gspread, googleapiclient и python-telegram-bot
+# работают как обычно (со всеми очередями квот, повторами и кэшами проекта),
+# но вместо сети получают ответы от этих классов. Задержку и ошибки можно
+# настроить; счётчик calls показывает, сколько вызовов API ушло и каких.
+
+_CELLS_RE = re.compile(r'^[A-Z]+\d*(:[A-Z]+\d*)?$')
+
+
+class FakeService:
+    """Поведение одного API: задержка, доля ошибок 5xx и 429, счётчик вызовов."""
+
+    def __init__(self, name, latency=0.0, jitter=0.0, error_rate=0.0, quota_rate=0.0, seed=None):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _enter(self, op):
+        """Учитывает вызов; возвращает (задержка, HTTP-статус ошибки или None)."""
+        with self._lock:
+            self.calls[op] += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            roll = self._random.random()
+            status = None
+            if roll < self.quota_rate:
+                status = 429
+            elif roll < self.quota_rate + self.error_rate:
+                status = 503
+            if status:
+                self.errors[op, status] += 1
+            return delay, status
+
+    def enter(self, op):
+        delay, status = self._enter(op)
+        if delay:
+            time.sleep(delay)
+        return status
+
+    async def aenter(self, op):
+        delay, status = self._enter(op)
+        if delay:
+            await asyncio.sleep(delay)
+        return status
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+# --- Google Sheets ---
+class FakeSpreadsheet:
+    """Таблица в памяти: листы -> список строк."""
+
+    def __init__(self, sheet_id='fake-sheet', title='kons', sheets=None):
+        self.id = sheet_id
+        self.title = title
+        self.sheets = {}
+        self._lock = threading.Lock()
+        for name, rows in (sheets or {}).items():
+            self.add_sheet(name, rows)
+
+    def add_sheet(self, title, rows=(), row_count=1000, col_count=26):
+        with self._lock:
+            self.sheets[title] = {
+                'id': len(self.sheets) + 1,
+                'rows': [[str(v) for v in row] for row in rows],
+                'row_count': row_count,
+                'col_count': col_count,
+            }
+            return self._properties(title)
+
+    def _properties(self, title):
+        sheet = self.sheets[title]
+        return {
+            'sheetId': sheet['id'],
+            'title': title,
+            'index': list(self.sheets).index(title),
+            'sheetType': 'GRID',
+            'gridProperties': {'rowCount': sheet['row_count'], 'columnCount': sheet['col_count']},
+        }
+
+    def metadata(self):
+        return {
+            'spreadsheetId': self.id,
+            'properties': {'title': self.title, 'locale': 'ru_RU', 'timeZone': 'Europe/Moscow'},
+            'sheets': [{'properties': self._properties(t)} for t in self.sheets],
+        }
+
+    def _parse(self, a1):
+        if '!' in a1:
+            title, cells = a1.rsplit('!', 1)
+        elif _CELLS_RE.match(a1):
+            title, cells = None, a1
+        else:
+            title, cells = a1, ''
+        if title and title.startswith("'") and title.endswith("'"):
+            title = title[1:-1].replace("''", "'")
+        title = title or next(iter(self.sheets))
+        if title not in self.sheets:
+            raise KeyError(title)
+        start, _, end = cells.partition(':')
+        return title, start or None, end or None
+
+    def get(self, a1):
+        title, start, end = self._parse(a1)
+        rows = self.sheets[title]['rows']
+        if not start:
+            return title, [list(r) for r in rows]
+        # диапазон столбцов без номеров строк ('F:F') — все строки листа
+        r1, c1 = a1_to_rowcol(start) if start[-1].isdigit() else (1, a1_to_rowcol(start + '1')[1])
+        if not end:
+            r2, c2 = r1, c1
+        else:
+            r2, c2 = a1_to_rowcol(end) if end[-1].isdigit() else (len(rows), a1_to_rowcol(end + '1')[1])
+        return title, [row[c1 - 1:c2] for row in rows[r1 - 1:r2]]
+
+    def write(self, a1, values):
+        title, start, _ = self._parse(a1)
+        r1, c1 = a1_to_rowcol(start or 'A1')
+        rows = self.sheets[title]['rows']
+        with self._lock:
+            for i, vals in enumerate(values):
+                while len(rows) < r1 + i:
+                    rows.append([])
+                row = rows[r1 + i - 1]
+                row += [''] * (c1 - 1 + len(vals) - len(row))
+                for j, v in enumerate(vals):
+                    row[c1 - 1 + j] = '' if v is None else str(v)
+        return f"'{title}'!{rowcol_to_a1(r1, c1)}:{rowcol_to_a1(r1 + len(values) - 1, c1 + max(map(len, values), default=1) - 1)}"
+
+    def append(self, a1, values):
+        title, _, _ = self._parse(a1)
+        with self._lock:
+            rows = self.sheets[title]['rows']
+            start = len(rows) + 1
+            rows.extend([['' if v is None else str(v) for v in vals] for vals in values])
+        width = max(map(len, values), default=1)
+        return f"'{title}'!A{start}:{rowcol_to_a1(start + len(values) - 1, width)}"
+
+
+class FakeSheetsSession:
+    """HTTP-сессия для gspread.Client, которая отвечает из FakeSpreadsheet."""
+
+    def __init__(self, spreadsheet, service):
+        self.spreadsheet = spreadsheet
+        self.service = service
+        self.headers = {}
+
+    def _response(self, status, data):
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+
+    def _error(self, status):
+        message = 'Quota exceeded' if status == 429 else 'Service unavailable'
+        return self._response(status, {'error': {'code': status, 'message': message, 'status': 'UNAVAILABLE'}})
+
+    def request(self, method, url, params=None, json=None, **kwargs):
+        path = urlsplit(url).path
+        if path.startswith('/drive/v3/files/'):
+            # gspread при открытии таблицы спрашивает у Drive её даты создания и изменения
+            status = self.service.enter('drive.files.get')
+            if status:
+                return self._error(status)
+            now = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+            return self._response(200, {'id': self.spreadsheet.id, 'name': self.spreadsheet.title,
+                                        'createdTime': now, 'modifiedTime': now})
+        path = path.split('/v4/spreadsheets/', 1)[1]
+        sheet_id, _, rest = path.partition('/')
+        if ':' in sheet_id:
+            sheet_id, action = sheet_id.split(':', 1)
+        else:
+            action = None
+        op, handler = self._route(method, rest, action)
+        status = self.service.enter(op)
+        if status:
+            return self._error(status)
+        try:
+            return self._response(200, handler(params or {}, json or {}))
+        except KeyError as e:
+            return self._response(400, {'error': {'code': 400, 'message': f'Unable to parse range: {e}',
+                                                  'status': 'INVALID_ARGUMENT'}})
+
+    def _route(self, method, rest, action):
+        book = self.spreadsheet
+        if action == 'batchUpdate':
+            def add_sheet(params, body):
+                replies = []
+                for req in body.get('requests', []):
+                    props = req['addSheet']['properties']
+                    grid = props.get('gridProperties', {})
+                    replies.append({'addSheet': {'properties': book.add_sheet(
+                        props['title'], row_count=int(grid.get('rowCount', 1000)),
+                        col_count=int(grid.get('columnCount', 26)))}})
+                return {'spreadsheetId': book.id, 'replies': replies}
+            return 'batchUpdate', add_sheet
+        if not rest:
+            return 'get', lambda params, body: book.metadata()
+        if rest == 'values:batchUpdate':
+            def batch_update(params, body):
+                return {'responses': [{'updatedRange': book.write(d['range'], d['values'])} for d in body['data']]}
+            return 'values.batchUpdate', batch_update
+        rng = unquote(rest.split('/', 1)[1])
+        if rng.endswith(':append'):
+            def append(params, body):
+                return {'updates': {'updatedRange': book.append(rng[:-len(':append')], body['values'])}}
+            return 'values.append', append
+        if method == 'put':
+            return 'values.update', lambda params, body: {'updatedRange': book.write(rng, body['values'])}
+
+        def get(params, body):
+            title, values = book.get(rng)
+            # как настоящий API: хвостовые пустые ячейки и строки не возвращаются
+            values = [list(r) for r in values]
+            for row in values:
+                while row and row[-1] == '':
+                    row.pop()
+            while values and not values[-1]:
+                values.pop()
+            data = {'range': f"'{title}'", 'majorDimension': 'ROWS'}
+            if values:
+                data['values'] = values
+            return data
+        return 'values.get', get
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('post', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('put', url, **kwargs)
+
+
+# --- Google Drive ---
+class FakeDriveHttp:
+    """Объект http для googleapiclient: загрузки файлов, права и пакетные запросы."""
+
+    def __init__(self, service):
+        self.service = service
+        self.files = {}
+        self._ids = iter(range(1, 10 ** 9))
+        self._lock = threading.Lock()
+
+    def _json(self, status, data):
+        return httplib2.Response({'status': str(status), 'content-type': 'application/json'}), \
+            json.dumps(data).encode('utf-8')
+
+    def _call(self, method, uri, body):
+        path = urlsplit(uri).path
+        if '/permissions' in path:
+            op = 'permissions.create'
+        elif path.endswith('/files'):
+            op = 'files.create'
+        else:
+            op = f'{method} {path}'
+        status = self.service.enter(op)
+        if status:
+            return status, {'error': {'code': status, 'message': 'Rate Limit Exceeded' if status == 429
+                                      else 'Backend Error'}}
+        if op == 'files.create':
+            with self._lock:
+                file_id = f'fake{next(self._ids)}'
+                self.files[file_id] = len(body or b'')
+            return 200, {'id': file_id}
+        if op == 'permissions.create':
+            return 200, {'id': 'anyoneWithLink', 'type': 'anyone', 'role': 'reader'}
+        return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+    def _batch(self, body, headers):
+        # пакетный запрос: multipart/mixed из HTTP-запросов, ответ в том же виде
+        content_type = next(v for k, v in headers.items() if k.lower() == 'content-type')
+        message = BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + (body if isinstance(body, bytes) else body.encode())
+        )
+        boundary = 'fake_batch_boundary'
+        parts = []
+        for part in message.get_payload():
+            request_line = part.get_payload().lstrip().split('\n', 1)[0]
+            method, uri = request_line.split(' ')[:2]
+            status, data = self._call(method, uri, None)
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                f'Content-Type: application/json\r\n\r\n{json.dumps(data)}\r\n'
+            )
+        content = ''.join(parts) + f'--{boundary}--\r\n'
+        return httplib2.Response({'status': '200', 'content-type': f'multipart/mixed; boundary={boundary}'}), \
+            content.encode('utf-8')
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        if '/batch/' in urlsplit(uri).path:
+            return self._batch(body, headers or {})
+        status, data = self._call(method, uri, body)
+        return self._json(status, data)
+
+
+# --- Telegram Bot API ---
+class FakeTelegram:
+    """Ответы Bot API для HTTPXRequest.do_request.
+
+    sent — сколько сообщений ушло в каждый чат, texts и markups — последний
+    текст и последняя клавиатура чата (по ним можно «нажимать» кнопки).
+    """
+
+    def __init__(self, service, bot_id=1, username='kons_fake_bot'):
+        self.service = service
+        self.bot_id = bot_id
+        self.username = username
+        self.sent = Counter()
+        self.texts = {}
+        self.markups = {}
+        self._message_ids = iter(range(1, 10 ** 9))
+
+    def _message(self, params):
+        chat_id = int(params.get('chat_id', 0))
+        self.sent[chat_id] += 1
+        if 'text' in params:
+            self.texts[chat_id] = params['text']
+        if 'reply_markup' in params:
+            self.markups[chat_id] = params['reply_markup']
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'kons', 'username': self.username},
+            'text': params.get('text', ''),
+        }
+
+    def respond(self, method, params):
+        if method == 'getMe':
+            return {'id': self.bot_id, 'is_bot': True, 'first_name': 'kons', 'username': self.username,
+                    'can_join_groups': False, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': False}
+        if method in ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageReplyMarkup'):
+            return self._message(params)
+        if method == 'getUpdates':
+            return []
+        return True
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[1]
+        status = await self.service.aenter(api_method)
+        if status == 429:
+            body = {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                    'parameters': {'retry_after': 1}}
+        elif status:
+            body = {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+            status = 502
+        else:
+            params = request_data.parameters if request_data else {}
+            body = {'ok': True, 'result': self.respond(api_method, params)}
+        return status or 200, json.dumps(body).encode('utf-8')
+
+
+class FakeBackends:
+    """Все три заменителя вместе; install() подключает их к google_clients и PTB.
+
+    install() нужно вызвать до импорта server и bot: они создают клиентов
+    и очереди при импорте.
+    """
+
+    def __init__(self, sheets=None, latency=0.0, jitter=0.0, error_rate=0.0, quota_rate=0.0, seed=None):
+        options = dict(latency=latency, jitter=jitter, error_rate=error_rate, quota_rate=quota_rate, seed=seed)
+        self.sheets = FakeService('sheets', **options)
+        self.drive = FakeService('drive', **options)
+        self.telegram = FakeService('telegram', **options)
+        self.spreadsheet = FakeSpreadsheet(os.environ.get('SHEET_ID', 'fake-sheet'), sheets=sheets)
+        self.drive_http = FakeDriveHttp(self.drive)
+        self.bot_api = FakeTelegram(self.telegram)
+
+    def services(self):
+        return [self.sheets, self.drive, self.telegram]
+
+    def install(self):
+        import gspread
+        import google_clients
+        from googleapiclient.discovery import build
+        from telegram.request import HTTPXRequest
+
+        session = FakeSheetsSession(self.spreadsheet, self.sheets)
+        google_clients.gspread_client = lambda: gspread.Client(auth=None, session=session)
+        google_clients.build_drive = lambda: build(
+            'drive', 'v3', http=self.drive_http, requestBuilder=google_clients.ScheduledHttpRequest,
+            static_discovery=True, cache_discovery=False,
+        )
+        bot_api = self.bot_api
+
+        async def do_request(request, url, method, request_data=None, **kwargs):
+            return await bot_api.do_request(url, method, request_data, **kwargs)
+
+        HTTPXRequest.do_request = do_request
+        return self
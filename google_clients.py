@@ -0,0 +1,199 @@
+import os
+import json
+import threading
+import gspread
+from gspread.exceptions import WorksheetNotFound
+from google.oauth2.service_account import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+from quota import Scheduler, WRITE, READ, BACKGROUND
+
+SCOPES = [
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/spreadsheets"
+]
+# Метаданные таблицы и листов кэшируются на диске, чтобы старт не ждал Google
+GOOGLE_CACHE_DIR = os.environ.get("GOOGLE_CACHE_DIR", ".google_cache")
+# Квоты API: все вызовы Sheets и Drive процесса идут через эти очереди.
+# Лимиты — на один процесс: бот и каждый воркер gunicorn получают свой,
+# поэтому их сумма по всем процессам не должна превышать квоту проекта
+# (Sheets — 60 запросов в минуту на пользователя). По умолчанию — треть
+# квоты: бот и два воркера.
+SHEETS_REQUESTS_PER_MINUTE = int(os.environ.get("SHEETS_REQUESTS_PER_MINUTE", "20"))
+DRIVE_REQUESTS_PER_MINUTE = int(os.environ.get("DRIVE_REQUESTS_PER_MINUTE", "200"))
+
+sheets_scheduler = Scheduler("sheets", SHEETS_REQUESTS_PER_MINUTE)
+drive_scheduler = Scheduler("drive", DRIVE_REQUESTS_PER_MINUTE)
+
+# Методы листа, которые ходят в API, и их приоритет
+WORKSHEET_CALLS = {
+    "get_all_values": BACKGROUND,
+    "get_all_records": BACKGROUND,
+    "cell": READ,
+    "get": READ,
+    "row_values": READ,
+    "append_row": WRITE,
+    "append_rows": WRITE,
+    "update_cell": WRITE,
+    "update": WRITE,
+    "batch_update": WRITE,
+}
+
+_lock = threading.RLock()
+_state = {}     # клиенты текущего процесса; после fork создаются заново
+
+
+class CachedSpreadsheet(gspread.Spreadsheet):
+    """Таблица со свойствами из дискового кэша: создаётся без запросов к API."""
+
+    def __init__(self, client, properties):
+        self.client = client
+        self._properties = properties
+
+
+def _process_state():
+    if _state.get("pid") != os.getpid():
+        _state.clear()
+        _state["pid"] = os.getpid()
+        _state["worksheets"] = {}
+    return _state
+
+
+def credentials():
+    with _lock:
+        state = _process_state()
+        if "creds" not in state:
+            creds_json = os.environ.get("GSPREAD_CREDENTIALS_JSON")
+            if not creds_json:
+                raise RuntimeError("Missing GSPREAD_CREDENTIALS_JSON environment variable")
+            state["creds"] = Credentials.from_service_account_info(json.loads(creds_json), scopes=SCOPES)
+        return state["creds"]
+
+
+def gspread_client():
+    """Один клиент gspread (и одна HTTP-сессия) на процесс."""
+    with _lock:
+        state = _process_state()
+        if "gc" not in state:
+            state["gc"] = gspread.authorize(credentials())
+        return state["gc"]
+
+
+class ScheduledHttpRequest(HttpRequest):
+    """Запрос Drive, который выполняется через общую очередь квоты."""
+
+    def execute(self, http=None, num_retries=0):
+        return drive_scheduler.call(super().execute, http=http, priority=WRITE, op=self.methodId)
+
+
+def build_drive():
+    # документ discovery берётся из пакета (static_discovery), без сетевого запроса
+    return build("drive", "v3", credentials=credentials(), requestBuilder=ScheduledHttpRequest,
+                 static_discovery=True, cache_discovery=False)
+
+
+# --- Таблица и листы ---
+def _cache_path(sheet_id):
+    return os.path.join(GOOGLE_CACHE_DIR, f"{sheet_id}.json")
+
+def _load_meta(sheet_id):
+    try:
+        with open(_cache_path(sheet_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _save_meta(sheet_id, meta):
+    os.makedirs(GOOGLE_CACHE_DIR, exist_ok=True)
+    tmp = _cache_path(sheet_id) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, _cache_path(sheet_id))
+
+def _sheet_id():
+    sheet_id = os.environ.get("SHEET_ID")
+    if not sheet_id:
+        raise RuntimeError("Missing SHEET_ID environment variable")
+    return sheet_id
+
+def _refresh_meta(spreadsheet):
+    data = sheets_scheduler.call(spreadsheet.fetch_sheet_metadata, key=("metadata", spreadsheet.id))
+    meta = {
+        "properties": dict(spreadsheet._properties, **data["properties"]),
+        "sheets": {s["properties"]["title"]: s["properties"] for s in data["sheets"]},
+    }
+    _save_meta(spreadsheet.id, meta)
+    return meta
+
+def spreadsheet():
+    with _lock:
+        state = _process_state()
+        if "sheet" not in state:
+            sheet_id = _sheet_id()
+            meta = _load_meta(sheet_id)
+            if meta:
+                state["sheet"] = CachedSpreadsheet(gspread_client(), dict(meta["properties"]))
+            else:
+                state["sheet"] = sheets_scheduler.call(gspread_client().open_by_key, sheet_id)
+                _refresh_meta(state["sheet"])
+        return state["sheet"]
+
+def worksheet(title, create=None):
+    """Лист по названию; create=(rows, cols) — создать, если его нет."""
+    with _lock:
+        cache = _process_state()["worksheets"]
+        if title in cache:
+            return cache[title]
+        sheet = spreadsheet()
+        meta = _load_meta(sheet.id) or {}
+        props = meta.get("sheets", {}).get(title)
+        if props is None:
+            props = _refresh_meta(sheet)["sheets"].get(title)
+        if props is None:
+            if create is None:
+                raise WorksheetNotFound(title)
+            ws = sheets_scheduler.call(sheet.add_worksheet, title=title, rows=create[0], cols=create[1],
+                                       priority=WRITE)
+            _refresh_meta(sheet)
+        else:
+            ws = gspread.Worksheet(sheet, dict(props))
+        cache[title] = ws
+        return ws
+
+
+class LazyWorksheet:
+    """Лист, который открывается при первом обращении к нему.
+
+    Вызовы API листа (WORKSHEET_CALLS) идут через sheets_scheduler;
+    одинаковые одновременные чтения склеиваются в один запрос. key=None
+    отключает склейку — для чтений, которые должны увидеть уже сделанную
+    запись.
+    """
+
+    def __init__(self, title, create=None):
+        self._title = title
+        self._create = create
+
+    @property
+    def title(self):
+        return self._title
+
+    def __getattr__(self, name):
+        attr = getattr(worksheet(self._title, self._create), name)
+        priority = WORKSHEET_CALLS.get(name)
+        if priority is None:
+            return attr
+
+        def scheduled(*args, **kwargs):
+            if "key" in kwargs:
+                key = kwargs.pop("key")
+            elif priority != WRITE:
+                key = (self._title, name, args, tuple(sorted(kwargs.items())))
+            else:
+                key = None
+            return sheets_scheduler.call(attr, *args, priority=priority, key=key, **kwargs)
+
+        return scheduled
+
+    def __repr__(self):
+        return f"<LazyWorksheet {self._title!r}>"
@@ -0,0 +1,9 @@
+# Приложение импортируется один раз в мастере, воркеры получают его через fork.
+# На импорте нет сетевых запросов: клиенты Google создаются при первом обращении.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # потоки журнала и обработки фото не переживают fork — запускаем в воркере
+    import server as app_module
+    app_module.start_background()
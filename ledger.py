@@ -0,0 +1,135 @@
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from slots import DATE_FORMAT, TIME_FORMAT
+
+# Журнал записей на консультации: локальная SQLite с индексами для отчётов.
+# Лист «Заявки» по-прежнему получает каждую запись, но запросы идут сюда.
+# При STORAGE_BACKEND=sqlite журнал живёт в базе хранилища, а не в отдельном файле
+LEDGER_PATH = os.environ.get('LEDGER_PATH', 'bookings.db')
+# Сколько строк читается за один запрос при выгрузке
+LEDGER_CHUNK = int(os.environ.get('LEDGER_CHUNK', '500'))
+
+SLOT_KEY = '%Y-%m-%d %H:%M'   # так слот хранится в базе: строки сортируются по времени
+COLUMNS = ['id', 'slot', 'expert_id', 'expert_name', 'client_id', 'client_name', 'source', 'created']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bookings (
+    id          INTEGER PRIMARY KEY,
+    slot        TEXT NOT NULL,
+    expert_id   TEXT NOT NULL DEFAULT '',
+    expert_name TEXT NOT NULL DEFAULT '',
+    client_id   TEXT NOT NULL DEFAULT '',
+    client_name TEXT NOT NULL DEFAULT '',
+    source      TEXT NOT NULL,
+    created     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bookings_slot ON bookings (slot, id);
+CREATE INDEX IF NOT EXISTS bookings_expert_id ON bookings (expert_id, slot, id);
+CREATE INDEX IF NOT EXISTS bookings_expert_name ON bookings (expert_name, slot, id);
+CREATE INDEX IF NOT EXISTS bookings_client_id ON bookings (client_id, slot, id);
+CREATE INDEX IF NOT EXISTS bookings_client_name ON bookings (client_name, slot, id);
+"""
+
+
+def parse_when(date, time):
+    """Дата и время записи: 'дд.мм.гг' или 'ГГГГ-ММ-ДД' и 'ЧЧ:ММ'; ValueError, если не разобрать."""
+    for fmt in (DATE_FORMAT, '%Y-%m-%d'):
+        try:
+            return datetime.strptime(f"{date} {time}", f"{fmt} {TIME_FORMAT}")
+        except ValueError:
+            pass
+    raise ValueError(f"{date} {time}")
+
+
+def parse_day(value):
+    """Граница диапазона в запросе: 'ГГГГ-ММ-ДД' или 'дд.мм.гг'."""
+    for fmt in ('%Y-%m-%d', DATE_FORMAT):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+class BookingLedger:
+    """Записи на консультации с индексами по эксперту, клиенту и дате.
+
+    Эксперт и клиент ищутся по Telegram ID или по имени. Выборки идут
+    страницами по ключу (slot, id), поэтому iter() отдаёт историю любого
+    размера, держа в памяти не больше одной страницы.
+
+    connect — функция, возвращающая соединение чужой базы (хранилища);
+    тогда запись можно сделать в её транзакции через insert().
+    """
+
+    def __init__(self, path=LEDGER_PATH, chunk=LEDGER_CHUNK, connect=None):
+        self.path = path
+        self.chunk = chunk
+        self._connect = connect
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        if self._connect is not None:
+            return self._connect()
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def add(self, slot, expert_id='', expert_name='', client_id='', client_name='', source=''):
+        return self.insert(self._db(), slot, expert_id, expert_name, client_id, client_name, source)
+
+    @staticmethod
+    def insert(db, slot, expert_id='', expert_name='', client_id='', client_name='', source=''):
+        """Добавляет запись через соединение db (например, внутри транзакции хранилища)."""
+        cur = db.execute(
+            'INSERT INTO bookings (slot, expert_id, expert_name, client_id, client_name, source, created) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (slot.strftime(SLOT_KEY), str(expert_id), expert_name, str(client_id), client_name, source, time.time()),
+        )
+        return cur.lastrowid
+
+    def query(self, expert=None, client=None, start=None, end=None, limit=100, after=None):
+        """Записи по фильтрам, по возрастанию времени слота.
+
+        start и end — даты включительно; after — (slot, id) последней
+        записи предыдущей страницы.
+        """
+        where, params = [], []
+        if expert:
+            where.append('(expert_id = ? OR expert_name = ?)')
+            params += [str(expert), str(expert)]
+        if client:
+            where.append('(client_id = ? OR client_name = ?)')
+            params += [str(client), str(client)]
+        if start:
+            where.append('slot >= ?')
+            params.append(start.strftime(SLOT_KEY))
+        if end:
+            where.append('slot < ?')
+            params.append((end + timedelta(days=1)).strftime(SLOT_KEY))
+        if after:
+            where.append('(slot, id) > (?, ?)')
+            params += list(after)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM bookings"
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY slot, id LIMIT ?'
+        params.append(limit)
+        return [dict(zip(COLUMNS, row)) for row in self._db().execute(sql, params)]
+
+    def iter(self, **filters):
+        after = None
+        while True:
+            page = self.query(limit=self.chunk, after=after, **filters)
+            yield from page
+            if len(page) < self.chunk:
+                return
+            after = (page[-1]['slot'], page[-1]['id'])
@@ -0,0 +1,28 @@
+import threading
+from contextlib import contextmanager
+
+
+class KeyedLock:
+    """Блокировки по ключу: операции с одним ключом идут по очереди, с разными — параллельно.
+
+    Блокировка ключа живёт, пока её кто-то держит или ждёт, так что словарь
+    не растёт с числом ключей.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}  # ключ -> [Lock, число держащих и ждущих]
+
+    @contextmanager
+    def __call__(self, key):
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
@@ -0,0 +1,219 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Метрики процесса в текстовом формате Prometheus (GET /metrics) и трассировка
+# внешних вызовов одного обработчика. Счётчики свои у каждого процесса:
+# при нескольких воркерах gunicorn каждый отдаёт только свои.
+#
+# Трассировка: если задан TRACE_SLOW (секунды), для каждого HTTP-запроса и
+# обработчика бота собирается список вызовов Sheets/Drive/Telegram, и он
+# пишется в лог, когда обработка заняла не меньше TRACE_SLOW (0 — всегда).
+TRACE_SLOW = os.environ.get('TRACE_SLOW')
+TRACE_SLOW = float(TRACE_SLOW) if TRACE_SLOW else None
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+log = logging.getLogger(__name__)
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, n in items:
+            yield f'{self.name}{_labels(self.labels, values)} {_number(n)}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}   # метки -> [счётчики корзин..., сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *values):
+        with self._lock:
+            data = self._values.get(values)
+            if data is None:
+                data = self._values[values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += seconds
+            data[-1] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            items = sorted((values, list(data)) for values, data in self._values.items())
+        for values, data in items:
+            total = 0
+            for bound, n in zip(self.buckets, data):
+                total += n
+                le = _labels(self.labels, values, f'le="{bound}"')
+                yield f'{self.name}_bucket{le} {total}'
+            le = _labels(self.labels, values, 'le="+Inf"')
+            yield f'{self.name}_bucket{le} {data[-1]}'
+            yield f'{self.name}_sum{_labels(self.labels, values)} {data[-2]!r}'
+            yield f'{self.name}_count{_labels(self.labels, values)} {data[-1]}'
+
+
+# --- Метрики ---
+EXTERNAL_SECONDS = Histogram(
+    'kons_external_call_seconds', 'Длительность вызова внешнего API (одна попытка)', ('api', 'method'))
+EXTERNAL_CALLS = Counter(
+    'kons_external_calls_total', 'Вызовы внешних API по результату: ok, HTTP-код ошибки или error',
+    ('api', 'method', 'status'))
+EXTERNAL_RETRIES = Counter('kons_external_retries_total', 'Повторы после 429 и 5xx', ('api',))
+COALESCED = Counter(
+    'kons_external_coalesced_total', 'Чтения, получившие результат уже выполнявшегося запроса', ('api', 'method'))
+QUOTA_WAIT = Histogram('kons_quota_wait_seconds', 'Ожидание квоты перед вызовом API', ('api',))
+HANDLER_SECONDS = Histogram(
+    'kons_handler_seconds', 'Длительность обработки HTTP-запроса или обновления бота', ('kind', 'handler'))
+HANDLER_CALLS = Counter(
+    'kons_handler_calls_total', 'Обработанные запросы и обновления по результату', ('kind', 'handler', 'status'))
+
+_METRICS = [EXTERNAL_SECONDS, EXTERNAL_CALLS, EXTERNAL_RETRIES, COALESCED, QUOTA_WAIT,
+            HANDLER_SECONDS, HANDLER_CALLS]
+_queues = {}   # имя очереди -> функция, возвращающая её длину
+
+
+def queue(name, size):
+    """Регистрирует очередь: size() вызывается при каждом чтении /metrics."""
+    _queues[name] = size
+
+
+def _render_queues():
+    yield '# HELP kons_queue_depth Длина внутренних очередей'
+    yield '# TYPE kons_queue_depth gauge'
+    for name, size in sorted(_queues.items()):
+        try:
+            value = size()
+        except Exception:
+            continue
+        yield f'kons_queue_depth{_labels(("queue",), (name,))} {value}'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus."""
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    lines.extend(_render_queues())
+    return '\n'.join(lines) + '\n'
+
+
+# --- Трассировка ---
+_current = contextvars.ContextVar('kons_trace', default=None)
+
+
+class Trace:
+    """Внешние вызовы одного обработчика: (api, метод, секунды, статус, ожидание квоты)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+        self.started = time.perf_counter()
+        self._token = _current.set(self)
+
+    def close(self):
+        _current.reset(self._token)
+
+    def lines(self):
+        return [
+            f"{api}.{method} {seconds * 1000:.1f} мс {status}" + (f" (квота {wait * 1000:.1f} мс)" if wait else '')
+            for api, method, seconds, status, wait in self.calls
+        ]
+
+    def server_timing(self, total):
+        """Значение заголовка Server-Timing: вызовы по порядку и общее время."""
+        parts = [
+            f'c{i};desc="{api} {method} {status}";dur={seconds * 1000:.1f}'
+            for i, (api, method, seconds, status, wait) in enumerate(self.calls)
+        ]
+        parts.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(parts)
+
+    def log(self, total):
+        if TRACE_SLOW is not None and total >= TRACE_SLOW:
+            log.info('%s: %.1f мс, внешних вызовов %s%s', self.name, total * 1000, len(self.calls),
+                     ''.join('\n  ' + line for line in self.lines()))
+
+
+def status_of(code):
+    """Метка результата для HTTP-кода внешнего API."""
+    return 'ok' if code is None or code < 400 else str(code)
+
+
+def external_call(api, method, seconds, status='ok', wait=0.0):
+    """Учитывает одну попытку вызова внешнего API и добавляет её в текущую трассировку."""
+    EXTERNAL_SECONDS.observe(seconds, api, method)
+    EXTERNAL_CALLS.inc(api, method, status)
+    trace = _current.get()
+    if trace is not None:
+        trace.calls.append((api, method, seconds, status, wait))
+
+
+def coalesced(api, method, seconds):
+    COALESCED.inc(api, method)
+    trace = _current.get()
+    if trace is not None:
+        trace.calls.append((api, method, seconds, 'coalesced', 0.0))
+
+
+def handled(kind, name, seconds, status):
+    HANDLER_SECONDS.observe(seconds, kind, name)
+    HANDLER_CALLS.inc(kind, name, str(status))
+
+
+@contextmanager
+def timed_handler(kind, name):
+    """Время и результат обработчика; при TRACE_SLOW — ещё и трассировка его вызовов."""
+    trace = Trace(f"{kind} {name}") if TRACE_SLOW is not None else None
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        total = time.perf_counter() - started
+        handled(kind, name, total, status)
+        if trace is not None:
+            trace.close()
+            trace.log(total)
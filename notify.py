@@ -0,0 +1,204 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import sqlite3
+import threading
+from telegram.error import RetryAfter, NetworkError, Forbidden, BadRequest
+import metrics
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 в секунду в один чат
+NOTIFY_PER_SECOND = float(os.environ.get('NOTIFY_PER_SECOND', '25'))
+NOTIFY_CHAT_INTERVAL = float(os.environ.get('NOTIFY_CHAT_INTERVAL', '1'))
+NOTIFY_MAX_RETRIES = int(os.environ.get('NOTIFY_MAX_RETRIES', '5'))
+# Напоминания о консультации: за сколько минут до слота, через запятую
+REMINDERS_PATH = os.environ.get('REMINDERS_PATH', 'reminders.db')
+REMINDER_OFFSETS = [int(m) for m in os.environ.get('REMINDER_OFFSETS', '1440,60').split(',') if m.strip()]
+
+log = logging.getLogger(__name__)
+
+
+class Notifier:
+    """Очередь исходящих сообщений бота.
+
+    send() только ставит сообщение в очередь и сразу возвращается, отправляет
+    фоновая задача: не чаще per_second сообщений в секунду всего и не чаще
+    одного в chat_interval секунд в один чат; сообщения одного чата уходят
+    по порядку. На RetryAfter отправка приостанавливается на указанное
+    Telegram время, сетевые ошибки повторяются с растущей задержкой.
+    """
+
+    def __init__(self, bot, per_second=NOTIFY_PER_SECOND, chat_interval=NOTIFY_CHAT_INTERVAL,
+                 max_retries=NOTIFY_MAX_RETRIES):
+        self.bot = bot
+        self.interval = 1.0 / per_second
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._heap = []          # (когда можно отправлять, номер, chat_id, kwargs, попытка)
+        self._seq = itertools.count()
+        self._chat_next = {}     # chat_id -> когда в этот чат можно писать снова
+        self._next = 0.0         # когда можно отправить следующее сообщение вообще
+        self._wake = None
+        self._task = None
+        metrics.queue('notify', self.qsize)
+
+    def qsize(self):
+        return len(self._heap)
+
+    def send(self, chat_id, text, **kwargs):
+        kwargs['text'] = text
+        self._push(time.monotonic(), next(self._seq), chat_id, kwargs, 0)
+
+    def _push(self, ready, seq, chat_id, kwargs, attempt):
+        heapq.heappush(self._heap, (ready, seq, chat_id, kwargs, attempt))
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _sleep(self, delay):
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._sleep(None)
+                continue
+            now = time.monotonic()
+            ready = max(self._heap[0][0], self._next)
+            if ready > now:
+                await self._sleep(ready - now)
+                continue
+            ready, seq, chat_id, kwargs, attempt = heapq.heappop(self._heap)
+            chat_next = self._chat_next.get(chat_id, 0.0)
+            if chat_next > now:
+                # номер сохраняется — порядок сообщений чата не меняется
+                self._push(chat_next, seq, chat_id, kwargs, attempt)
+                continue
+            self._next = now + self.interval
+            self._chat_next[chat_id] = now + self.chat_interval
+            try:
+                await self.bot.send_message(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                log.warning('Telegram просит подождать %s с', e.retry_after)
+                self._next = time.monotonic() + e.retry_after
+                self._push(ready, seq, chat_id, kwargs, attempt)
+            except (Forbidden, BadRequest) as e:
+                # бот заблокирован или чат не существует — повтор не поможет
+                log.warning('Сообщение в чат %s не доставлено: %s', chat_id, e)
+            except NetworkError as e:
+                if attempt >= self.max_retries:
+                    log.error('Сообщение в чат %s не доставлено: %s', chat_id, e)
+                else:
+                    # откладываем весь чат, чтобы следующие сообщения не обогнали это
+                    self._chat_next[chat_id] = time.monotonic() + 2 ** attempt
+                    self._push(ready, seq, chat_id, kwargs, attempt + 1)
+            except Exception:
+                log.exception('Ошибка при отправке сообщения в чат %s', chat_id)
+            # старые отметки чатов больше ни на что не влияют
+            if len(self._chat_next) > 10000:
+                now = time.monotonic()
+                self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10):
+        # даём отправить то, что уже в очереди
+        deadline = time.monotonic() + timeout
+        while self._heap and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._heap:
+            log.warning('Не отправлено сообщений: %s', len(self._heap))
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+REMINDERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reminders (
+    id      INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    send_at REAL NOT NULL,
+    slot_at REAL NOT NULL,
+    text    TEXT NOT NULL,
+    sent    INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS reminders_pending ON reminders (sent, send_at);
+"""
+
+
+class Reminders:
+    """Напоминания о записи, сохранённые в SQLite и поставленные в JobQueue.
+
+    Каждое напоминание сначала записывается в базу, потом планируется;
+    после перезапуска load() планирует все неотправленные заново, а те,
+    чьё время прошло, пока бот был выключен, отправляет сразу (если слот
+    ещё не начался).
+    """
+
+    def __init__(self, notifier, job_queue, path=REMINDERS_PATH, offsets=REMINDER_OFFSETS):
+        self.notifier = notifier
+        self.job_queue = job_queue
+        self.path = path
+        self.offsets = offsets
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(REMINDERS_SCHEMA)
+
+    def _store(self, items):
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN')
+                return [
+                    self._db.execute(
+                        'INSERT INTO reminders (chat_id, send_at, slot_at, text) VALUES (?, ?, ?, ?)', item
+                    ).lastrowid
+                    for item in items
+                ]
+
+    def _mark_sent(self, reminder_id):
+        with self._lock:
+            self._db.execute('UPDATE reminders SET sent = 1 WHERE id = ?', (reminder_id,))
+
+    def _pending(self):
+        with self._lock:
+            # о прошедших консультациях напоминать уже незачем
+            self._db.execute('UPDATE reminders SET sent = 1 WHERE sent = 0 AND slot_at <= ?', (time.time(),))
+            return self._db.execute(
+                'SELECT id, chat_id, send_at, text FROM reminders WHERE sent = 0'
+            ).fetchall()
+
+    def _schedule(self, reminder_id, chat_id, send_at, text):
+        self.job_queue.run_once(
+            self._fire, when=max(0.0, send_at - time.time()),
+            data=(reminder_id, chat_id, text), name=f'reminder-{reminder_id}',
+        )
+
+    async def _fire(self, context):
+        reminder_id, chat_id, text = context.job.data
+        self.notifier.send(chat_id, text)
+        await asyncio.to_thread(self._mark_sent, reminder_id)
+
+    async def add(self, slot, messages):
+        """Планирует напоминания о слоте slot (datetime); messages — [(chat_id, текст)]."""
+        start = slot.timestamp()
+        items = [
+            (chat_id, start - minutes * 60, start, text)
+            for minutes in self.offsets for chat_id, text in messages
+            if start - minutes * 60 > time.time()
+        ]
+        ids = await asyncio.to_thread(self._store, items)
+        for reminder_id, (chat_id, send_at, _, text) in zip(ids, items):
+            self._schedule(reminder_id, chat_id, send_at, text)
+
+    async def load(self):
+        pending = await asyncio.to_thread(self._pending)
+        for reminder_id, chat_id, send_at, text in pending:
+            self._schedule(reminder_id, chat_id, send_at, text)
+        log.info('Запланировано напоминаний: %s', len(pending))
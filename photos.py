@@ -0,0 +1,189 @@
+import io
+import os
+import re
+import json
+import uuid
+import fcntl
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.http import MediaIoBaseUpload
+from PIL import Image, ImageOps
+from google_clients import drive_scheduler
+from quota import WRITE
+
+# Каталог, куда складываются загруженные фото и состояние задач
+PHOTO_SPOOL_DIR = os.environ.get('PHOTO_SPOOL_DIR', 'spool')
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', '2'))
+# Длинная сторона фото и превью после пережатия, в пикселях
+PHOTO_MAX_SIZE = int(os.environ.get('PHOTO_MAX_SIZE', '1280'))
+PHOTO_THUMB_SIZE = int(os.environ.get('PHOTO_THUMB_SIZE', '320'))
+PHOTO_QUALITY = int(os.environ.get('PHOTO_QUALITY', '85'))
+
+QUEUED, PROCESSING, DONE, FAILED = 'queued', 'processing', 'done', 'failed'
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+log = logging.getLogger(__name__)
+
+
+def drive_url(file_id):
+    return f"https://drive.google.com/uc?id={file_id}"
+
+
+def shrink(data, max_size, quality=PHOTO_QUALITY):
+    """Уменьшает изображение до max_size по длинной стороне и пережимает в JPEG."""
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail((max_size, max_size))
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=quality, optimize=True)
+    return out.getvalue()
+
+
+class PhotoQueue:
+    """Фоновая обработка фото экспертов: пережатие, превью, загрузка в Drive.
+
+    submit() кладёт файл и данные задачи в спул и сразу возвращает ID задачи.
+    Пул потоков уменьшает фото, делает превью, загружает оба файла и выдаёт
+    доступ на чтение одним batch-запросом Drive, после чего вызывает
+    on_done(payload, photo_url, retry). Состояние задачи лежит в спуле рядом
+    с файлом, поэтому его видит любой воркер, а незавершённые задачи
+    подхватываются при перезапуске.
+
+    Результат загрузки и отметка registering сохраняются до вызова on_done,
+    отметка registered — после. Если задача прервалась между ними, on_done
+    вызывается повторно с retry=True: результат прошлого вызова мог уже
+    сохраниться, и on_done должен его проверить. Ошибка on_done оставляет
+    задачу незарегистрированной до следующего запуска.
+    """
+
+    def __init__(self, build_drive, folder_id, on_done, spool_dir=PHOTO_SPOOL_DIR, workers=PHOTO_WORKERS):
+        self.build_drive = build_drive
+        self.folder_id = folder_id
+        self.on_done = on_done
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self._local = threading.local()
+        self._executor = None
+        self._pid = None
+
+    # --- Спул ---
+    def _path(self, job_id, ext):
+        return os.path.join(self.spool_dir, f'{job_id}.{ext}')
+
+    def _save_state(self, job_id, state):
+        tmp = self._path(job_id, 'json.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, self._path(job_id, 'json'))
+
+    def status(self, job_id):
+        """Состояние задачи или None, если такой нет."""
+        if not _JOB_ID_RE.match(job_id or ''):
+            return None
+        try:
+            with open(self._path(job_id, 'json'), encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        state.pop('payload', None)
+        return state
+
+    def start(self):
+        """Запускает пул и ставит в очередь задачи, не завершённые до перезапуска."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='photos')
+        for name in os.listdir(self.spool_dir):
+            job_id, _, ext = name.partition('.')
+            state = self.status(job_id) if ext == 'json' else None
+            if state and (state['state'] in (QUEUED, PROCESSING) or state.get('registered') is False):
+                self._executor.submit(self._process, job_id)
+
+    def submit(self, file_storage, payload):
+        if self._pid != os.getpid():
+            self.start()
+        job_id = uuid.uuid4().hex
+        file_storage.save(self._path(job_id, 'upload'))
+        self._save_state(job_id, {
+            'job_id': job_id,
+            'state': QUEUED,
+            'filename': file_storage.filename,
+            'payload': payload,
+        })
+        self._executor.submit(self._process, job_id)
+        return job_id
+
+    # --- Обработка ---
+    def _drive(self):
+        # клиент Drive (httplib2) не потокобезопасен — свой на каждый поток
+        drive = getattr(self._local, 'drive', None)
+        if drive is None:
+            drive = self._local.drive = self.build_drive()
+        return drive
+
+    def _upload(self, drive, name, data):
+        meta = {"name": name, "parents": [self.folder_id]}
+        media = MediaIoBaseUpload(io.BytesIO(data), mimetype='image/jpeg', resumable=False)
+        return drive.files().create(body=meta, media_body=media, fields="id").execute()["id"]
+
+    def _share(self, drive, file_ids):
+        errors = []
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+
+        batch = drive.new_batch_http_request(callback=callback)
+        for file_id in file_ids:
+            batch.add(drive.permissions().create(fileId=file_id, body={"type": "anyone", "role": "reader"}))
+        drive_scheduler.call(batch.execute, priority=WRITE, op='batch')
+        if errors:
+            raise errors[0]
+
+    def _process(self, job_id):
+        upload_path = self._path(job_id, 'upload')
+        try:
+            upload = open(upload_path, 'rb')
+        except FileNotFoundError:
+            return  # задачу уже обработал другой процесс
+        with upload:
+            # задачу могли поставить в очередь два процесса — обрабатывает один
+            fcntl.flock(upload, fcntl.LOCK_EX)
+            with open(self._path(job_id, 'json'), encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('registered'):
+                return
+            if state['state'] not in (DONE, FAILED):
+                state['state'] = PROCESSING
+                self._save_state(job_id, state)
+                try:
+                    data = upload.read()
+                    base = os.path.splitext(state.get('filename') or job_id)[0]
+                    drive = self._drive()
+                    photo_id = self._upload(drive, f'{base}.jpg', shrink(data, PHOTO_MAX_SIZE))
+                    thumb_id = self._upload(drive, f'{base}_thumb.jpg', shrink(data, PHOTO_THUMB_SIZE))
+                    self._share(drive, [photo_id, thumb_id])
+                    state.update(state=DONE, photo_url=drive_url(photo_id), thumbnail_url=drive_url(thumb_id))
+                except Exception as e:
+                    log.exception('Не удалось обработать фото %s', job_id)
+                    state.update(state=FAILED, error=str(e))
+                state['registered'] = False
+                self._save_state(job_id, state)
+            retry = bool(state.get('registering'))
+            if not retry:
+                state['registering'] = True
+                self._save_state(job_id, state)
+            # эксперт регистрируется и без фото, если обработка не удалась
+            try:
+                self.on_done(state['payload'], state.get('photo_url', ''), retry)
+            except Exception:
+                log.exception('Не удалось зарегистрировать эксперта по задаче %s', job_id)
+                return
+            state['registered'] = True
+            self._save_state(job_id, state)
+            os.remove(upload_path)
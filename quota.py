@@ -0,0 +1,147 @@
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from concurrent.futures import Future
+import requests
+from gspread.exceptions import APIError
+from googleapiclient.errors import HttpError
+import metrics
+
+# Приоритеты запросов: меньше — раньше получает квоту
+WRITE, READ, BACKGROUND = 0, 1, 2
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+log = logging.getLogger(__name__)
+
+
+def error_status(exc):
+    """HTTP-статус ошибки gspread или googleapiclient (None, если это не ошибка API)."""
+    if isinstance(exc, APIError):
+        return exc.response.status_code
+    if isinstance(exc, HttpError):
+        return int(exc.resp.status)
+    return None
+
+
+def _retryable(exc, priority):
+    status = error_status(exc)
+    if priority == WRITE:
+        # запись после 5xx или обрыва могла уже примениться — повтор задвоит строку
+        # или файл; 429 же Google возвращает, не выполняя запрос
+        return status == 429
+    if status in RETRY_STATUSES:
+        return True
+    return isinstance(exc, (ConnectionError, TimeoutError,
+                            requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class Scheduler:
+    """Общая очередь вызовов одного API Google в пределах процесса.
+
+    - token bucket: не больше per_minute запросов в минуту, всплеск до burst;
+    - квоту первыми получают запросы с меньшим приоритетом (запись раньше
+      фонового чтения), при равном — в порядке прихода;
+    - одинаковые чтения (по key), выполняющиеся одновременно, склеиваются
+      в один запрос, результат получают все ожидающие;
+    - чтения повторяются после 429, 5xx и сетевых ошибок, записи (WRITE) —
+      только после 429; задержка экспоненциальная со случайным разбросом.
+
+    Каждая попытка учитывается в metrics под именем op (по умолчанию — имя fn).
+    """
+
+    def __init__(self, name, per_minute, burst=None, max_retries=5, backoff=1.0, max_backoff=32.0):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1, per_minute // 6)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []    # куча (приоритет, номер) ожидающих квоту
+        self._seq = itertools.count()
+        self._inflight = {}   # key -> Future выполняющегося чтения
+        metrics.queue(f"{name}_quota", self.waiting)
+
+    def waiting(self):
+        return len(self._waiters)
+
+    # --- Квота ---
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _acquire(self, priority):
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    self._refill()
+                    head = self._waiters[0] == entry
+                    if head and self._tokens >= 1:
+                        self._tokens -= 1
+                        heapq.heappop(self._waiters)
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait((1 - self._tokens) / self.rate if head else None)
+            except BaseException:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+                raise
+
+    # --- Вызовы ---
+    def _run(self, fn, args, kwargs, priority, op):
+        for attempt in itertools.count():
+            waited = time.perf_counter()
+            self._acquire(priority)
+            started = time.perf_counter()
+            metrics.QUOTA_WAIT.observe(started - waited, self.name)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                status = error_status(e)
+                metrics.external_call(self.name, op, time.perf_counter() - started,
+                                      metrics.status_of(status) if status else 'error', started - waited)
+                if attempt >= self.max_retries or not _retryable(e, priority):
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                log.warning('%s: %s, повтор через %.1f с', self.name, status or e, delay)
+                metrics.EXTERNAL_RETRIES.inc(self.name)
+                time.sleep(delay)
+            else:
+                metrics.external_call(self.name, op, time.perf_counter() - started, 'ok', started - waited)
+                return result
+
+    def call(self, fn, *args, priority=READ, key=None, op=None, **kwargs):
+        op = op or getattr(fn, '__name__', 'call')
+        if key is None:
+            return self._run(fn, args, kwargs, priority, op)
+        with self._cond:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            started = time.perf_counter()
+            try:
+                return future.result()
+            finally:
+                metrics.coalesced(self.name, op, time.perf_counter() - started)
+        try:
+            result = self._run(fn, args, kwargs, priority, op)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._cond:
+                self._inflight.pop(key, None)
+        future.set_result(result)
+        return result
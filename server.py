@@ -1,58 +1,114 @@
 import os
 import json
-from flask import Flask, request, jsonify, abort
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
-import gspread
-from gspread.exceptions import WorksheetNotFound
+import gzip
+import csv
+import hmac
+import itertools
+import hashlib
+import time
+import threading
+from io import StringIO
+from flask import Flask, request, jsonify, abort, stream_with_context, g
+from gspread.utils import numericise_all
+import google_clients
+import metrics
+from storage import open_repository
+from photos import PhotoQueue
+from ledger import COLUMNS as BOOKING_COLUMNS, parse_when, parse_day
 
 app = Flask(__name__)
 
-# 1) Получаем JSON с ключом из переменной окружения
-creds_json = os.environ.get("GSPREAD_CREDENTIALS_JSON")
-if not creds_json:
-    raise RuntimeError("Missing GSPREAD_CREDENTIALS_JSON environment variable")
-creds_dict = json.loads(creds_json)
-
-# 2) Инициализируем сервисные креды и подключаемся к Drive и Sheets API
-SCOPES = [
-    "https://www.googleapis.com/auth/drive",
-    "https://www.googleapis.com/auth/spreadsheets"
-]
-creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-drive_service = build("drive", "v3", credentials=creds)
-gc = gspread.authorize(creds)
-
-# 3) Открываем нужную таблицу
-SHEET_ID = os.environ.get("SHEET_ID")
-if not SHEET_ID:
-    raise RuntimeError("Missing SHEET_ID environment variable")
-sheet = gc.open_by_key(SHEET_ID)
-
-# 4) Готовим листы
-experts_ws = sheet.worksheet("Эксперты")
-users_ws   = sheet.worksheet("Users")
-try:
-    bookings_ws = sheet.worksheet("Заявки")
-except WorksheetNotFound:
-    bookings_ws = sheet.add_worksheet(title="Заявки", rows="1000", cols="5")
-
-# 5) Папка в Google Drive для картинок экспертов
+# 1) Хранилище: Google Sheets или локальная SQLite с копией в листах
+#    (STORAGE_BACKEND). Клиенты Google создаются лениво, при первом обращении;
+#    ключ и таблица — в GSPREAD_CREDENTIALS_JSON и SHEET_ID
+repo = open_repository()
+experts = repo.experts
+
+# 2) Папка в Google Drive для картинок экспертов
 FOLDER_ID = os.environ.get("DRIVE_FOLDER_ID")
 if not FOLDER_ID:
     raise RuntimeError("Missing DRIVE_FOLDER_ID environment variable")
 
-def upload_file_to_drive(file_storage):
-    """Заливает файл в Drive и возвращает прямую ссылку на просмотр."""
-    meta = {"name": file_storage.filename, "parents": [FOLDER_ID]}
-    media = MediaIoBaseUpload(file_storage.stream, mimetype=file_storage.mimetype)
-    f = drive_service.files().create(body=meta, media_body=media, fields="id").execute()
-    drive_service.permissions().create(
-        fileId=f["id"],
-        body={"type": "anyone", "role": "reader"}
-    ).execute()
-    return f"https://drive.google.com/uc?id={f['id']}"
+def expert_row(payload, photo_url):
+    # Ваша шапка: [ФИО эксперта, город эксперта, сфера, описание, photo_file_id, Telegram ID, Username, Slots]
+    return [
+        payload["fio"],
+        payload["city"],
+        payload["sphere"],
+        payload["description"],
+        photo_url,
+        # если нужно сохранять Telegram ID/Username — можно их тоже передать:
+        # request.form.get("telegram_id",""), request.form.get("username",""),
+        # иначе просто оставляйте пустые строки:
+        "", ""
+    ]
+
+def _same_row(a, b):
+    # значения из листа приходят разобранными ("007" -> 7), поэтому сравниваем разобранное
+    return numericise_all([str(v) for v in a]) == numericise_all([str(v) for v in b])
+
+def register_from_photo(payload, photo_url, retry=False):
+    """Добавляет эксперта после обработки фото.
+
+    retry — прошлая регистрация по этой задаче прервалась, и строка могла
+    уже добавиться: только тогда журнал отправляется и строка ищется в листе.
+    """
+    row = expert_row(payload, photo_url)
+    if retry:
+        repo.flush()
+        columns = ("ФИО эксперта", "Город", "сфера", "описание", "photo_file_id")
+        for _, existing in experts.rows():
+            if _same_row([existing.get(h, "") for h in columns], row[:5]):
+                return
+    repo.append("experts", row)
+
+# Фото экспертов обрабатываются и загружаются в Drive в фоне;
+# строка эксперта добавляется, когда загрузка закончена
+photo_queue = PhotoQueue(
+    build_drive=google_clients.build_drive,
+    folder_id=FOLDER_ID,
+    on_done=register_from_photo,
+)
+
+def start_background():
+    """Запускает фоновые потоки в текущем процессе (после fork — заново)."""
+    repo.start()
+    photo_queue.start()
+
+# Метрики: время и статус каждого маршрута; с заголовком X-Trace: 1 (или при
+# TRACE_SLOW) собираются все вызовы Sheets/Drive за запрос, и в ответ
+# добавляется Server-Timing со списком этих вызовов
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+    g.trace = None
+    if metrics.TRACE_SLOW is not None or _truthy(request.headers.get("X-Trace", "")):
+        g.trace = metrics.Trace(f"{request.method} {request.path}")
+
+@app.after_request
+def _observe(resp):
+    total = time.perf_counter() - g.started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.handled("http", route, total, resp.status_code)
+    if g.trace is not None:
+        if _truthy(request.headers.get("X-Trace", "")):
+            resp.headers["Server-Timing"] = g.trace.server_timing(total)
+        g.trace.log(total)
+    return resp
+
+@app.teardown_request
+def _end_trace(exc):
+    trace = g.pop("trace", None)
+    if trace is not None:
+        trace.close()
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+@app.before_request
+def _ensure_background():
+    start_background()
 
 # Healthcheck, чтоб Render не «засыпал»
 @app.route("/", methods=["GET", "HEAD"])
@@ -68,7 +124,7 @@ def register_user():
     if not name or not city:
         abort(400, "Missing required field")
     # Ваша шапка: [Имя, Город]
-    users_ws.append_row([name, city])
+    repo.append("users", [name, city])
     return jsonify({"status": "ok"}), 200
 
 # Регистрация эксперта (multipart/form-data)
@@ -80,28 +136,101 @@ def register_expert():
     description = request.form.get("description")
     if not all([fio, city, sphere, description]):
         abort(400, "Missing required field")
-    photo_url = ""
+    payload = {"fio": fio, "city": city, "sphere": sphere, "description": description}
     if "photo" in request.files:
-        photo_url = upload_file_to_drive(request.files["photo"])
-    # Ваша шапка: [ФИО эксперта, город эксперта, сфера, описание, photo_file_id, Telegram ID, Username, Slots]
-    experts_ws.append_row([
-        fio,
-        city,
-        sphere,
-        description,
-        photo_url,
-        # если нужно сохранять Telegram ID/Username — можно их тоже передать:
-        # request.form.get("telegram_id",""), request.form.get("username",""),
-        # иначе просто оставляйте пустые строки:
-        "", ""
-    ])
-    return jsonify({"status": "ok", "photo_url": photo_url}), 200
+        job_id = photo_queue.submit(request.files["photo"], payload)
+        return jsonify({
+            "status": "accepted",
+            "job_id": job_id,
+            "status_url": f"/register-expert/{job_id}",
+        }), 202
+    repo.append("experts", expert_row(payload, ""))
+    return jsonify({"status": "ok", "photo_url": ""}), 200
+
+# Состояние фоновой обработки фото: queued, processing, done или failed
+@app.route("/register-expert/<job_id>", methods=["GET"])
+def register_expert_status(job_id):
+    state = photo_queue.status(job_id)
+    if state is None:
+        abort(404, "Unknown job")
+    return jsonify(state), 200
 
 # Список экспертов для мобильного приложения
+# Параметры: city, sphere, has_free_slots=1, fields=ФИО эксперта,описание, limit, cursor.
+# Следующая страница — в заголовке X-Next-Cursor; тело по-прежнему JSON-массив.
+MAX_PAGE_SIZE = 200
+GZIP_MIN_SIZE = 1024
+MAX_CACHED_PAGES = 256
+_experts_pages = {}  # (версия каталога, минута, параметры) -> (etag, тело, тело в gzip, следующий курсор)
+_experts_pages_lock = threading.Lock()
+
+def _truthy(value):
+    return str(value).strip().lower() in ("1", "true", "yes")
+
+def _experts_page(args):
+    city   = args.get("city")
+    sphere = args.get("sphere")
+    free_only = _truthy(args.get("has_free_slots", ""))
+    fields = [f for f in args.get("fields", "").split(",") if f]
+    try:
+        limit  = min(int(args.get("limit", 0)), MAX_PAGE_SIZE)
+        cursor = int(args.get("cursor", 0))
+    except ValueError:
+        abort(400, "Invalid limit or cursor")
+    if limit < 0:
+        abort(400, "Invalid limit or cursor")
+    items, next_cursor, last = [], None, None
+    for row_num, row in experts.rows():
+        if row_num <= cursor:
+            continue
+        if city and str(row.get("Город", "")) != city:
+            continue
+        if sphere and str(row.get("сфера", "")) != sphere:
+            continue
+        if free_only and not len(experts.slot_index(row_num)):
+            continue
+        if limit and len(items) == limit:
+            next_cursor = last
+            break
+        items.append({f: row.get(f, "") for f in fields} if fields else row)
+        last = row_num
+    body = json.dumps(items, ensure_ascii=False).encode("utf-8")
+    etag = hashlib.sha1(body).hexdigest()
+    gz = gzip.compress(body) if len(body) >= GZIP_MIN_SIZE else None
+    return etag, body, gz, next_cursor
+
 @app.route("/consultation-experts", methods=["GET"])
 def get_experts():
-    rows = experts_ws.get_all_records()
-    return jsonify(rows), 200
+    # has_free_slots зависит и от времени: слоты истекают без записи в каталог,
+    # поэтому такие страницы живут не дольше минуты (точность слота)
+    minute = int(time.time() // 60) if _truthy(request.args.get("has_free_slots", "")) else None
+    key = (experts.current_version(), minute, tuple(sorted(request.args.items(multi=True))))
+    with _experts_pages_lock:
+        page = _experts_pages.get(key)
+    if page is None:
+        page = _experts_page(request.args)
+        with _experts_pages_lock:
+            # страницы старых версий каталога и прошедших минут больше не нужны
+            stale = [k for k in _experts_pages if k[0] != key[0] or k[1] not in (None, minute)]
+            for k in stale:
+                del _experts_pages[k]
+            if len(_experts_pages) >= MAX_CACHED_PAGES:
+                _experts_pages.clear()
+            _experts_pages[key] = page
+    etag, body, gz, next_cursor = page
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    elif gz is not None and "gzip" in request.accept_encodings:
+        resp = app.response_class(gz, mimetype="application/json")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.vary.add("Accept-Encoding")
+    if next_cursor is not None:
+        resp.headers["X-Next-Cursor"] = str(next_cursor)
+    return resp
 
 # Запись на консультацию (JSON)
 @app.route("/book-expert", methods=["POST"])
@@ -113,14 +242,100 @@ def book_expert():
     time_str    = data.get("time")
     if not all([fio, expert_name, date_str, time_str]):
         abort(400, "Missing required field")
-    # Ваша шапка «Заявки»: [ФИО, эксперт, дата, время]
-    bookings_ws.append_row([
-        fio,
-        expert_name,
-        date_str,
-        time_str
-    ])
+    try:
+        slot = parse_when(date_str, time_str)
+    except ValueError:
+        abort(400, "Invalid date or time")
+    # запись попадает в журнал и строкой в «Заявки»: [ФИО, эксперт, дата, время]
+    repo.record_booking(
+        slot, expert_id=_expert_id(expert_name), expert_name=expert_name,
+        client_name=fio, source="api",
+    )
     return jsonify({"status": "ok"}), 200
 
+def _expert_id(name):
+    for _, row in experts.rows():
+        if row.get("ФИО эксперта") == name:
+            return row.get("Telegram ID", "")
+    return ""
+
+# --- Отчёты по записям ---
+# Запросы передают REPORTS_TOKEN в Authorization: Bearer <токен>;
+# без REPORTS_TOKEN отчёты закрыты
+REPORTS_TOKEN = os.environ.get("REPORTS_TOKEN")
+MAX_BOOKINGS_PAGE = 1000
+
+def _booking_filters(args):
+    if not REPORTS_TOKEN or not hmac.compare_digest(
+            request.headers.get("Authorization", "").encode("utf-8"), f"Bearer {REPORTS_TOKEN}".encode("utf-8")):
+        abort(403)
+    try:
+        start = parse_day(args["from"]) if args.get("from") else None
+        end = parse_day(args["to"]) if args.get("to") else None
+    except ValueError:
+        abort(400, "Invalid from or to")
+    return {"expert": args.get("expert"), "client": args.get("client"), "start": start, "end": end}
+
+# Записи за период: expert (Telegram ID или ФИО), client, from, to (ГГГГ-ММ-ДД, включительно),
+# limit, cursor. Следующая страница — в заголовке X-Next-Cursor.
+@app.route("/bookings", methods=["GET"])
+def list_bookings():
+    filters = _booking_filters(request.args)
+    try:
+        limit = int(request.args.get("limit", 100))
+        after = None
+        if request.args.get("cursor"):
+            slot, _, booking_id = request.args["cursor"].rpartition(",")
+            after = (slot, int(booking_id))
+    except ValueError:
+        abort(400, "Invalid limit or cursor")
+    if not 1 <= limit <= MAX_BOOKINGS_PAGE:
+        abort(400, f"limit must be between 1 and {MAX_BOOKINGS_PAGE}")
+    items = repo.bookings.query(limit=limit, after=after, **filters)
+    resp = jsonify(items)
+    if len(items) == limit:
+        resp.headers["X-Next-Cursor"] = f"{items[-1]['slot']},{items[-1]['id']}"
+    return resp
+
+# Выгрузка записей целиком: format=ndjson (по умолчанию) или csv, фильтры как у /bookings.
+# Ответ отдаётся потоком: записи читаются из базы страницами и уходят кусками по EXPORT_CHUNK_SIZE.
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def _csv_line(values):
+    buf = StringIO()
+    csv.writer(buf).writerow(values)
+    return buf.getvalue()
+
+def _chunks(lines):
+    buf, size = [], 0
+    for line in lines:
+        buf.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf)
+
+@app.route("/bookings/export", methods=["GET"])
+def export_bookings():
+    filters = _booking_filters(request.args)
+    fmt = request.args.get("format", "ndjson")
+    items = repo.bookings.iter(**filters)
+    if fmt == "ndjson":
+        lines = (json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+        mimetype = "application/x-ndjson"
+    elif fmt == "csv":
+        header = [_csv_line(BOOKING_COLUMNS)]
+        rows = (_csv_line([item[c] for c in BOOKING_COLUMNS]) for item in items)
+        lines = itertools.chain(header, rows)
+        mimetype = "text/csv"
+    else:
+        abort(400, "Unknown format")
+    resp = app.response_class(stream_with_context(_chunks(lines)), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f"attachment; filename=bookings.{fmt}"
+    return resp
+
 if __name__ == "__main__":
+    start_background()
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import BasePersistence, PersistenceInput
+
+# Состояние диалогов хранится в SQLite и переживает перезапуск бота
+SESSIONS_PATH = os.environ.get('SESSIONS_PATH', 'sessions.db')
+# Как часто изменения сессий сбрасываются на диск, секунды
+SESSIONS_FLUSH_INTERVAL = float(os.environ.get('SESSIONS_FLUSH_INTERVAL', '5'))
+# Через сколько секунд без действий сессия и незаконченный диалог забываются
+SESSION_TTL = float(os.environ.get('SESSION_TTL', '86400'))
+
+log = logging.getLogger(__name__)
+
+# Поля сессии и их значения по умолчанию
+SESSION_FIELDS = {
+    # регистрация эксперта
+    'fio': None,
+    'city': None,
+    'field': None,
+    'desc': None,
+    # запись на консультацию
+    'selected_region': None,
+    'selected_field': None,
+    'expert_telegram_id': None,
+    'selected_date': None,
+}
+
+
+class Session:
+    """Состояние диалогов одного пользователя (ctx.user_data).
+
+    Хранит только id и выбранные значения; на диск пишутся поля,
+    отличающиеся от значений по умолчанию.
+    """
+
+    __slots__ = tuple(SESSION_FIELDS)
+
+    def __init__(self, **values):
+        for name, default in SESSION_FIELDS.items():
+            setattr(self, name, default)
+        for name, value in values.items():
+            if name in SESSION_FIELDS:
+                setattr(self, name, value)
+
+    def to_dict(self):
+        data = {}
+        for name, default in SESSION_FIELDS.items():
+            value = getattr(self, name)
+            if value != default:
+                data[name] = value
+        return data
+
+    def __repr__(self):
+        return f"Session({self.to_dict()!r})"
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INTEGER PRIMARY KEY,
+    data    TEXT NOT NULL,
+    touched REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_touched ON sessions (touched);
+CREATE TABLE IF NOT EXISTS conversations (
+    name    TEXT NOT NULL,
+    key     TEXT NOT NULL,
+    state   TEXT NOT NULL,
+    touched REAL NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+
+class SessionPersistence(BasePersistence):
+    """Persistence для python-telegram-bot: сессии (Session) и состояния диалогов в SQLite.
+
+    Application передаёт только изменившиеся сессии и диалоги; все изменения
+    одного прохода записываются одной транзакцией в отдельном потоке, в
+    порядке поступления. Сессии и диалоги, не менявшиеся дольше ttl, при
+    загрузке не поднимаются, а во время работы удаляются expire().
+    """
+
+    def __init__(self, path=SESSIONS_PATH, ttl=SESSION_TTL, update_interval=SESSIONS_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.ttl = ttl
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sessions')
+        self._pending = []
+        self._flushing = None
+
+    # --- Запись ---
+    def _commit(self, batch):
+        with self._db:
+            self._db.execute('BEGIN')
+            for sql, params in batch:
+                self._db.execute(sql, params)
+
+    async def _flush_batch(self):
+        await asyncio.sleep(0)  # даём остальным изменениям этого прохода встать в очередь
+        self._flushing = None
+        batch, self._pending = self._pending, []
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._commit, batch)
+
+    def _write(self, sql, params):
+        self._pending.append((sql, params))
+        if self._flushing is None:
+            self._flushing = asyncio.get_running_loop().create_task(self._flush_batch())
+        return self._flushing
+
+    async def _query(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # --- Сессии ---
+    def _load_sessions(self):
+        self._db.execute('DELETE FROM sessions WHERE touched < ?', (time.time() - self.ttl,))
+        return self._db.execute('SELECT user_id, data FROM sessions').fetchall()
+
+    async def get_user_data(self):
+        rows = await self._query(self._load_sessions)
+        return {user_id: Session(**json.loads(data)) for user_id, data in rows}
+
+    async def update_user_data(self, user_id, data):
+        await self._write(
+            'INSERT OR REPLACE INTO sessions (user_id, data, touched) VALUES (?, ?, ?)',
+            (user_id, json.dumps(data.to_dict(), ensure_ascii=False), time.time()),
+        )
+
+    async def drop_user_data(self, user_id):
+        await self._write('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    # --- Диалоги ---
+    def _load_conversations(self, name):
+        self._db.execute('DELETE FROM conversations WHERE name = ? AND touched < ?',
+                         (name, time.time() - self.ttl))
+        return self._db.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
+
+    async def get_conversations(self, name):
+        rows = await self._query(self._load_conversations, name)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await self._write('DELETE FROM conversations WHERE name = ? AND key = ?', (name, json.dumps(key)))
+        else:
+            await self._write(
+                'INSERT OR REPLACE INTO conversations (name, key, state, touched) VALUES (?, ?, ?, ?)',
+                (name, json.dumps(key), json.dumps(new_state), time.time()),
+            )
+
+    # --- Очистка ---
+    def _idle_users(self):
+        deadline = time.time() - self.ttl
+        self._db.execute('DELETE FROM conversations WHERE touched < ?', (deadline,))
+        return [r[0] for r in self._db.execute('SELECT user_id FROM sessions WHERE touched < ?', (deadline,))]
+
+    async def expire(self, context):
+        """Задача JobQueue: забывает сессии, которые не менялись дольше ttl."""
+        idle = await self._query(self._idle_users)
+        for user_id in idle:
+            context.application.drop_user_data(user_id)
+        if idle:
+            log.info('Удалено неактивных сессий: %s', len(idle))
+
+    async def flush(self):
+        if self._flushing is not None:
+            await self._flushing
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+    # --- Остальные данные не хранятся ---
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
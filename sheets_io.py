@@ -0,0 +1,39 @@
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# Сколько запросов к Google Sheets может выполняться одновременно
+SHEETS_CONCURRENCY = int(os.environ.get('SHEETS_CONCURRENCY', '8'))
+
+_executor = ThreadPoolExecutor(max_workers=SHEETS_CONCURRENCY, thread_name_prefix='sheets')
+_inflight = 0   # вызовы в очереди пула и выполняющиеся; меняется только в event loop
+
+
+def inflight():
+    return _inflight
+
+
+metrics.queue('sheets_io', inflight)
+
+
+async def run(fn, *args, **kwargs):
+    """Выполняет синхронный вызов gspread в пуле потоков, не блокируя event loop.
+
+    Контекст (трассировка metrics) переносится в поток вместе с вызовом.
+    """
+    global _inflight
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    _inflight += 1
+    try:
+        return await loop.run_in_executor(_executor, functools.partial(ctx.run, fn, *args, **kwargs))
+    finally:
+        _inflight -= 1
+
+
+def shutdown():
+    """Дожидается начатых вызовов; после этого run() больше не принимает задачи."""
+    _executor.shutdown(wait=True)
@@ -0,0 +1,136 @@
+import re
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from slots import DATE_FORMAT, TIME_FORMAT, expand_weekly
+
+# Выбор слотов экспертом целиком живёт в callback_data кнопок: сервер ничего
+# не хранит между нажатиями, поэтому выбор переживает перезапуск и работает
+# с любым числом процессов бота.
+#
+# Формат: t:<действие>:<день>:<даты>:<дни недели>:<часы> (числа — hex)
+#   день        — date.toordinal() дня, от которого отсчитываются даты;
+#   даты        — битовая маска смещений от этого дня (0..DATES_AHEAD-1);
+#   дни недели  — маска 0 (пн)..6 (вс); не 0 — выбран недельный шаблон;
+#   часы        — маска индексов в HOURS.
+# Самая длинная строка — около 25 байт при лимите Telegram в 64.
+DATES_AHEAD = 14
+HOURS = [f"{str(h).zfill(2)}:00" for h in range(8, 23)]
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+TEMPLATE_WEEKS = [1, 2, 4, 8]
+
+PREFIX = 't:'
+_DATA_RE = re.compile(r'^t:([a-zA-Z])(\d*):([0-9a-f]+):([0-9a-f]+):([0-9a-f]+):([0-9a-f]+)$')
+
+
+class PickerState(namedtuple('PickerState', 'base dates weekdays hours')):
+    """Выбор эксперта: день отсчёта (ordinal) и три битовые маски."""
+
+    __slots__ = ()
+
+    @classmethod
+    def new(cls, today=None):
+        return cls((today or date.today()).toordinal(), 0, 0, 0)
+
+    def toggle(self, field, bit):
+        return self._replace(**{field: getattr(self, field) ^ (1 << bit)})
+
+    def selected_dates(self):
+        first = date.fromordinal(self.base)
+        return [first + timedelta(days=i) for i in range(DATES_AHEAD) if self.dates >> i & 1]
+
+    def selected_weekdays(self):
+        return [d for d in range(7) if self.weekdays >> d & 1]
+
+    def selected_hours(self):
+        return [t for i, t in enumerate(HOURS) if self.hours >> i & 1]
+
+    def slots(self, weeks=None):
+        """Слоты выбора: даты × часы или, для шаблона, weeks недель от сегодня."""
+        times = self.selected_hours()
+        if self.weekdays:
+            return expand_weekly(self.selected_weekdays(), times, weeks)
+        return [
+            datetime.combine(day, datetime.strptime(t, TIME_FORMAT).time())
+            for day in self.selected_dates() for t in times
+        ]
+
+
+def encode(action, state, arg=''):
+    return f"{PREFIX}{action}{arg}:{state.base:x}:{state.dates:x}:{state.weekdays:x}:{state.hours:x}"
+
+
+def decode(data):
+    """callback_data -> (действие, аргумент или None, PickerState); ValueError, если данные чужие."""
+    m = _DATA_RE.match(data or '')
+    if not m:
+        raise ValueError(data)
+    action, arg, base, dates, weekdays, hours = m.groups()
+    state = PickerState(int(base, 16), int(dates, 16), int(weekdays, 16), int(hours, 16))
+    if state.dates >> DATES_AHEAD or state.weekdays >> 7 or state.hours >> len(HOURS):
+        raise ValueError(data)
+    return action, int(arg) if arg else None, state
+
+
+def date_labels(state):
+    return ', '.join(day.strftime(DATE_FORMAT) for day in state.selected_dates())
+
+
+def weekday_labels(state):
+    return ', '.join(WEEKDAYS[d] for d in state.selected_weekdays())
+
+
+# --- Клавиатуры ---
+# Подписи и раскладка каждой клавиатуры постоянны, меняются только отметки и
+# callback_data, поэтому готовые InlineKeyboardMarkup (неизменяемые) кэшируются
+# по состоянию: повторное нажатие — это разбор строки и взятие из кэша.
+@lru_cache(maxsize=32)
+def _date_labels(base):
+    first = date.fromordinal(base)
+    return tuple((first + timedelta(days=i)).strftime(DATE_FORMAT) for i in range(DATES_AHEAD))
+
+
+def _mark(label, on):
+    return f"✅ {label}" if on else label
+
+
+@lru_cache(maxsize=1024)
+def date_keyboard(state):
+    kb = [
+        [InlineKeyboardButton(_mark(label, state.dates >> i & 1), callback_data=encode('d', state, i))]
+        for i, label in enumerate(_date_labels(state.base))
+    ]
+    kb.append([InlineKeyboardButton("Далее ➡️", callback_data=encode('D', state))])
+    kb.append([InlineKeyboardButton("🔁 Шаблон на несколько недель", callback_data=encode('T', state))])
+    kb.append([InlineKeyboardButton("🗑 Очистить выбранные даты", callback_data=encode('X', state))])
+    return InlineKeyboardMarkup(kb)
+
+
+@lru_cache(maxsize=1024)
+def weekday_keyboard(state):
+    kb = [[
+        InlineKeyboardButton(_mark(name, state.weekdays >> i & 1), callback_data=encode('w', state, i))
+        for i, name in enumerate(WEEKDAYS)
+    ]]
+    kb.append([InlineKeyboardButton("Далее ➡️", callback_data=encode('W', state))])
+    kb.append([InlineKeyboardButton("⬅️ Назад", callback_data=encode('B', state))])
+    return InlineKeyboardMarkup(kb)
+
+
+@lru_cache(maxsize=1024)
+def hour_keyboard(state):
+    kb = [
+        [InlineKeyboardButton(_mark(t, state.hours >> i & 1), callback_data=encode('h', state, i))]
+        for i, t in enumerate(HOURS)
+    ]
+    kb.append([InlineKeyboardButton("Подтвердить", callback_data=encode('C', state))])
+    kb.append([InlineKeyboardButton("⬅️ Назад", callback_data=encode('B', state))])
+    return InlineKeyboardMarkup(kb)
+
+
+@lru_cache(maxsize=256)
+def weeks_keyboard(state):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"{n} нед.", callback_data=encode('n', state, n)) for n in TEMPLATE_WEEKS
+    ]])
@@ -0,0 +1,208 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from locks import KeyedLock
+
+# Столбцы листа «Эксперты»
+TELEGRAM_ID_COL = 6
+SLOTS_COL = 8
+
+# Формат ячейки Slots: 'dd.mm.yy HH:MM;dd.mm.yy HH:MM;...'
+DATE_FORMAT = '%d.%m.%y'
+TIME_FORMAT = '%H:%M'
+SLOT_FORMAT = f'{DATE_FORMAT} {TIME_FORMAT}'
+
+# Результаты бронирования слота
+BOOKED = 'booked'
+TAKEN = 'taken'
+NOT_FOUND = 'not_found'
+
+
+def split_slots(value):
+    return [s.strip() for s in str(value or '').split(';') if s.strip()]
+
+
+def parse_slot(date, time):
+    return datetime.strptime(f"{date} {time}", SLOT_FORMAT)
+
+
+def parse_date(date):
+    return datetime.strptime(date, DATE_FORMAT).date()
+
+
+def expand_weekly(weekdays, times, weeks, start=None):
+    """Слоты по недельному шаблону: дни недели (0 — пн) × время 'HH:MM' на weeks недель от start."""
+    start = start or datetime.now().date()
+    hours = [datetime.strptime(t, TIME_FORMAT).time() for t in times]
+    slots = []
+    for offset in range(weeks * 7):
+        day = start + timedelta(days=offset)
+        if day.weekday() in weekdays:
+            slots += [datetime.combine(day, t) for t in hours]
+    return slots
+
+
+class SlotIndex:
+    """Слоты одного эксперта: отсортированный список datetime.
+
+    Даты и время на дату ищутся бинарным поиском, в строку листа индекс
+    превращается только при записи (serialize). Ячейку правят люди, поэтому
+    нераспознанные элементы не теряются: они не считаются слотами, но
+    пишутся обратно как есть.
+    """
+
+    __slots__ = ('_slots', '_dates', '_other')
+
+    def __init__(self, slots=(), other=()):
+        self._slots = sorted(set(slots))
+        self._dates = None
+        self._other = list(other)
+
+    @classmethod
+    def parse(cls, value):
+        slots, other = [], []
+        for el in split_slots(value):
+            try:
+                slots.append(datetime.strptime(el, SLOT_FORMAT))
+            except ValueError:
+                other.append(el)
+        return cls(slots, other)
+
+    def serialize(self):
+        return ';'.join([dt.strftime(SLOT_FORMAT) for dt in self._slots] + self._other)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __contains__(self, dt):
+        i = bisect_left(self._slots, dt)
+        return i < len(self._slots) and self._slots[i] == dt
+
+    def dates(self):
+        """Даты, на которые есть слоты, по возрастанию."""
+        if self._dates is None:
+            dates = []
+            for dt in self._slots:
+                if not dates or dates[-1] != dt.date():
+                    dates.append(dt.date())
+            self._dates = dates
+        return self._dates
+
+    def on_date(self, day):
+        """Слоты на дату day по возрастанию времени."""
+        start = datetime.combine(day, datetime.min.time())
+        lo = bisect_left(self._slots, start)
+        hi = bisect_left(self._slots, start + timedelta(days=1), lo)
+        return self._slots[lo:hi]
+
+    def add(self, slots):
+        new = set(slots).difference(self._slots)
+        if new:
+            self._slots = sorted(self._slots + list(new))
+            self._dates = None
+        return len(new)
+
+    def remove(self, slots):
+        gone = set(slots).intersection(self._slots)
+        if gone:
+            self._slots = [dt for dt in self._slots if dt not in gone]
+            self._dates = None
+        return len(gone)
+
+    def clear(self, dates=None):
+        """Удаляет слоты на указанные даты (все, если dates не задан — вместе с нераспознанными)."""
+        if dates is None:
+            gone = len(self._slots)
+            self._slots = []
+            self._other = []
+            self._dates = None
+            return gone
+        return self.remove([dt for day in set(dates) for dt in self.on_date(day)])
+
+    def prune(self, now=None):
+        """Удаляет прошедшие слоты."""
+        i = bisect_right(self._slots, now or datetime.now())
+        if i:
+            del self._slots[:i]
+            self._dates = None
+        return i
+
+
+class SlotEngine:
+    """Изменение слотов экспертов: по одному изменению на эксперта за раз.
+
+    Каждое изменение перечитывает ячейку Slots под блокировкой эксперта,
+    поэтому одновременные записи к одному эксперту не теряют друг друга,
+    а один слот не достаётся двоим. Разные эксперты обновляются параллельно.
+    """
+
+    def __init__(self, directory, on_miss=None):
+        self.directory = directory
+        self.on_miss = on_miss
+        self._locks = KeyedLock()
+
+    def _find_row(self, telegram_id):
+        row_num, _ = self.directory.find(telegram_id)
+        if row_num is None and self.on_miss:
+            self.on_miss()
+            row_num, _ = self.directory.find(telegram_id)
+        return row_num
+
+    def _read(self, telegram_id):
+        """Строка эксперта и разобранная ячейка Slots, сверенные с Telegram ID в листе.
+
+        Если строка уже чужая (в листе вставляли или удаляли строки),
+        каталог перечитывается и эксперт ищется заново. (None, None) —
+        эксперта нет.
+        """
+        for _ in range(2):
+            row_num = self._find_row(telegram_id)
+            if not row_num:
+                return None, None
+            value = self.directory.read_slots(row_num, telegram_id)
+            if value is not None:
+                index = SlotIndex.parse(value)
+                index.prune()
+                return row_num, index
+        return None, None
+
+    def book(self, telegram_id, date, time):
+        """Забирает слот, если он ещё свободен: BOOKED, TAKEN или NOT_FOUND.
+
+        Нераспознанные дата или время — TAKEN: такого слота у эксперта нет.
+        """
+        try:
+            slot = parse_slot(date, time)
+        except ValueError:
+            return TAKEN
+        with self._locks(str(telegram_id)):
+            row_num, index = self._read(telegram_id)
+            if not row_num:
+                return NOT_FOUND
+            if slot not in index:
+                return TAKEN
+            index.remove([slot])
+            self.directory.update_cell(row_num, SLOTS_COL, index.serialize())
+            return BOOKED
+
+    def add_many(self, telegram_id, slots):
+        with self._locks(str(telegram_id)):
+            row_num, index = self._read(telegram_id)
+            if not row_num:
+                return False
+            index.add(slots)
+            self.directory.update_cell(row_num, SLOTS_COL, index.serialize())
+            return True
+
+    def clear(self, telegram_id, dates=None):
+        """Удаляет слоты эксперта на даты dates (все, если не задано): число удалённых или None."""
+        with self._locks(str(telegram_id)):
+            row_num, index = self._read(telegram_id)
+            if not row_num:
+                return None
+            gone = index.clear(dates)
+            if gone:
+                self.directory.update_cell(row_num, SLOTS_COL, index.serialize())
+            return gone
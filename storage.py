@@ -0,0 +1,530 @@
+import os
+import json
+import fcntl
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from gspread.utils import numericise_all, rowcol_to_a1
+from google_clients import LazyWorksheet
+from experts import ExpertDirectory, ROW_RE
+from appender import AppendWriter
+from slots import (SlotEngine, SlotIndex, BOOKED, TAKEN, NOT_FOUND, DATE_FORMAT, TIME_FORMAT, SLOTS_COL,
+                   TELEGRAM_ID_COL, parse_slot)
+from ledger import (BookingLedger, SCHEMA as LEDGER_SCHEMA, LEDGER_PATH, COLUMNS as LEDGER_COLUMNS, SLOT_KEY,
+                    parse_when)
+
+# sheets — данные только в Google Sheets; sqlite — локальная база, листы — её копия
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sheets')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'kons.db')
+# 0 — не отправлять изменения в Google Sheets и не загружать из них экспертов
+# (работа без доступа к Google)
+SHEETS_REPLICATION = os.environ.get('SHEETS_REPLICATION', '1') != '0'
+REPLICATION_INTERVAL = float(os.environ.get('REPLICATION_INTERVAL', '2'))
+REPLICATION_BATCH = int(os.environ.get('REPLICATION_BATCH', '500'))
+
+# Листы и их столбцы: (столбец базы, заголовок листа)
+EXPERT_COLUMNS = [
+    ('fio', 'ФИО эксперта'),
+    ('city', 'Город'),
+    ('sphere', 'сфера'),
+    ('description', 'описание'),
+    ('photo', 'photo_file_id'),
+    ('telegram_id', 'Telegram ID'),
+    ('username', 'Username'),
+    ('slots', 'Slots'),
+]
+TABLES = {
+    'experts':  ('Эксперты', [c for c, _ in EXPERT_COLUMNS]),
+    'users':    ('Users', ['name', 'city']),
+    'bookings': ('Заявки', ['fio', 'expert_name', 'date', 'time']),
+}
+
+log = logging.getLogger(__name__)
+
+
+def _worksheet(table):
+    title = TABLES[table][0]
+    if table == 'bookings':
+        return LazyWorksheet(title, create=("1000", "5"))
+    return LazyWorksheet(title)
+
+
+def booking_row(slot, expert_name, client_name):
+    # шапка «Заявки»: [ФИО, эксперт, дата, время]
+    return [client_name, expert_name, slot.strftime(DATE_FORMAT), slot.strftime(TIME_FORMAT)]
+
+
+class SheetsRepository:
+    """Хранилище поверх Google Sheets: кэш экспертов, журнал добавлений, блокировки слотов."""
+
+    def __init__(self):
+        self.experts = ExpertDirectory(_worksheet('experts'))
+        self._writers = {
+            'experts': AppendWriter(self.experts, 'experts'),
+            'users': AppendWriter(_worksheet('users'), 'users'),
+            'bookings': AppendWriter(_worksheet('bookings'), 'bookings'),
+        }
+        # эксперт мог только что зарегистрироваться, а строка ещё ждёт отправки
+        self._slots = SlotEngine(self.experts, on_miss=self._writers['experts'].flush)
+        self.bookings = BookingLedger()
+
+    def start(self):
+        for writer in self._writers.values():
+            writer.start()
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+
+    def append(self, table, row):
+        self._writers[table].append(row)
+
+    def book_slot(self, telegram_id, date, time):
+        return self._slots.book(telegram_id, date, time)
+
+    def add_slots(self, telegram_id, slots):
+        return self._slots.add_many(telegram_id, slots)
+
+    def clear_slots(self, telegram_id, dates=None):
+        return self._slots.clear(telegram_id, dates)
+
+    def record_booking(self, slot, expert_id='', expert_name='', client_id='', client_name='', source=''):
+        """Запись на консультацию: в журнал bookings и строкой в лист «Заявки»."""
+        self.bookings.add(slot, expert_id, expert_name, client_id, client_name, source)
+        self.append('bookings', booking_row(slot, expert_name, client_name))
+
+
+# --- SQLite ---
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS experts (
+    id          INTEGER PRIMARY KEY,
+    sheet_row   INTEGER,
+    fio         TEXT NOT NULL DEFAULT '',
+    city        TEXT NOT NULL DEFAULT '',
+    sphere      TEXT NOT NULL DEFAULT '',
+    description TEXT NOT NULL DEFAULT '',
+    photo       TEXT NOT NULL DEFAULT '',
+    telegram_id TEXT NOT NULL DEFAULT '',
+    username    TEXT NOT NULL DEFAULT '',
+    slots       TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS experts_telegram_id ON experts (telegram_id);
+CREATE INDEX IF NOT EXISTS experts_city_sphere ON experts (city, sphere);
+CREATE TABLE IF NOT EXISTS users (
+    id   INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    city TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    tbl     TEXT NOT NULL,
+    op      TEXT NOT NULL,
+    ref     INTEGER NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('experts_version', 0);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('experts_imported', 0);
+"""
+
+
+class SqliteExpertDirectory(ExpertDirectory):
+    """Каталог экспертов, читаемый из SQLite.
+
+    Таблица перечитывается, только когда в базе сменилась версия экспертов
+    (её увеличивает каждая запись, в том числе из других процессов). Ключ
+    записи — id строки в базе, а не номер строки листа.
+    """
+
+    def __init__(self, repo):
+        super().__init__(ws=None, ttl=0)
+        self.repo = repo
+        self._db_version = None
+
+    def _fresh(self):
+        return self._db_version is not None and self._db_version == self.repo.experts_version()
+
+    def _load(self):
+        with self.repo.read() as db:
+            db_version = db.execute("SELECT value FROM meta WHERE key = 'experts_version'").fetchone()[0]
+            rows = db.execute(
+                f"SELECT id, {', '.join(c for c, _ in EXPERT_COLUMNS)} FROM experts ORDER BY id"
+            ).fetchall()
+        header = [h for _, h in EXPERT_COLUMNS]
+        self._fill(header, {
+            r[0]: dict(zip(header, numericise_all([str(v) for v in r[1:]])))
+            for r in rows
+        })
+        self._db_version = db_version
+
+
+class SqliteRepository:
+    """Хранилище в SQLite (WAL) — основная копия данных.
+
+    Каждое изменение в той же транзакции пишется в таблицу outbox;
+    SheetsReplicator переносит его в листы пачками, так что таблица Google
+    остаётся представлением для людей, но не лежит на пути запросов.
+    """
+
+    def __init__(self, path=SQLITE_PATH, replicate=SHEETS_REPLICATION):
+        self.path = path
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+        self.experts = SqliteExpertDirectory(self)
+        self._migrate_bookings()
+        # журнал записей — в этой же базе: запись и её строка outbox в одной транзакции
+        self.bookings = BookingLedger(connect=self._db)
+        self.replicator = SheetsReplicator(self) if replicate else None
+
+    # --- Соединения ---
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @contextmanager
+    def read(self):
+        yield self._db()
+
+    @contextmanager
+    def write(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _migrate_bookings(self, ledger_path=LEDGER_PATH):
+        """Заменяет прежнюю таблицу bookings (ФИО, эксперт, дата, время) журналом записей.
+
+        В журнал переносятся записи из отдельного файла журнала (ledger_path)
+        и строки старой таблицы, которых в нём нет. Выполняется один раз:
+        после переноса старой таблицы не остаётся.
+        """
+        def legacy(db):
+            return 'fio' in [r[1] for r in db.execute('PRAGMA table_info(bookings)')]
+
+        if not legacy(self._db()):
+            return
+        saved = []
+        if os.path.exists(ledger_path):
+            old = sqlite3.connect(ledger_path)
+            try:
+                saved = old.execute(f"SELECT {', '.join(LEDGER_COLUMNS[1:])} FROM bookings ORDER BY id").fetchall()
+            except sqlite3.DatabaseError:
+                pass
+            finally:
+                old.close()
+        with self.write() as db:
+            if not legacy(db):
+                return
+            rows = db.execute('SELECT fio, expert_name, date, time FROM bookings ORDER BY id').fetchall()
+            db.execute('DROP TABLE bookings')
+            for statement in LEDGER_SCHEMA.split(';'):
+                db.execute(statement)
+            db.executemany(
+                f"INSERT INTO bookings ({', '.join(LEDGER_COLUMNS[1:])}) "
+                f"VALUES ({', '.join('?' * (len(LEDGER_COLUMNS) - 1))})", saved,
+            )
+            known = {(r[0], r[2], r[4]) for r in saved}  # (slot, эксперт, клиент)
+            skipped = 0
+            for fio, expert_name, date, time in rows:
+                try:
+                    slot = parse_when(date, time)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if (slot.strftime(SLOT_KEY), expert_name, fio) not in known:
+                    BookingLedger.insert(db, slot, expert_name=expert_name, client_name=fio, source='legacy')
+        log.info('Журнал записей перенесён в %s (%s из файла, %s строк старой таблицы, пропущено %s)',
+                 self.path, len(saved), len(rows), skipped)
+
+    def experts_version(self):
+        return self._db().execute("SELECT value FROM meta WHERE key = 'experts_version'").fetchone()[0]
+
+    @staticmethod
+    def _bump(db):
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'experts_version'")
+
+    @staticmethod
+    def _outbox(db, table, op, ref, payload):
+        db.execute(
+            'INSERT INTO outbox (tbl, op, ref, payload) VALUES (?, ?, ?, ?)',
+            (table, op, ref, json.dumps(payload, ensure_ascii=False)),
+        )
+
+    # --- Интерфейс хранилища ---
+    def start(self):
+        # экспертов из листа загружает поток репликации: старт не ждёт Google
+        if self.replicator:
+            self.replicator.start()
+
+    def flush(self):
+        if self.replicator:
+            self.replicator.wakeup()
+
+    def append(self, table, row):
+        columns = TABLES[table][1]
+        values = [str(v) for v in list(row)[:len(columns)]]
+        values += [''] * (len(columns) - len(values))
+        with self.write() as db:
+            cur = db.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                values,
+            )
+            self._outbox(db, table, 'append', cur.lastrowid, list(row))
+            if table == 'experts':
+                self._bump(db)
+
+    def _update_slots(self, telegram_id, change):
+        """Применяет change(index) к слотам эксперта в одной транзакции.
+
+        change возвращает True, если слоты нужно сохранить. Результат — это
+        значение или None, если эксперта нет. Транзакция BEGIN IMMEDIATE
+        сериализует изменения между всеми процессами и длится микросекунды.
+        """
+        with self.write() as db:
+            found = db.execute(
+                'SELECT id, slots FROM experts WHERE telegram_id = ? ORDER BY id LIMIT 1', (str(telegram_id),)
+            ).fetchone()
+            if not found:
+                return None
+            expert_id, value = found
+            index = SlotIndex.parse(value)
+            index.prune()
+            changed = change(index)
+            if changed:
+                value = index.serialize()
+                db.execute('UPDATE experts SET slots = ? WHERE id = ?', (value, expert_id))
+                self._outbox(db, 'experts', 'update', expert_id, {'col': SLOTS_COL, 'value': value})
+                self._bump(db)
+            return changed
+
+    def book_slot(self, telegram_id, date, time):
+        try:
+            slot = parse_slot(date, time)
+        except ValueError:
+            return TAKEN
+        taken = self._update_slots(telegram_id, lambda index: index.remove([slot]) > 0)
+        if taken is None:
+            return NOT_FOUND
+        return BOOKED if taken else TAKEN
+
+    def add_slots(self, telegram_id, slots):
+        def add(index):
+            index.add(slots)
+            return True
+
+        return bool(self._update_slots(telegram_id, add))
+
+    def clear_slots(self, telegram_id, dates=None):
+        gone = []
+
+        def clear(index):
+            gone.append(index.clear(dates))
+            return gone[0] > 0
+
+        if self._update_slots(telegram_id, clear) is None:
+            return None
+        return gone[0]
+
+    def record_booking(self, slot, expert_id='', expert_name='', client_id='', client_name='', source=''):
+        """Запись на консультацию: в журнал и в outbox для листа «Заявки» одной транзакцией."""
+        with self.write() as db:
+            booking_id = self.bookings.insert(db, slot, expert_id, expert_name, client_id, client_name, source)
+            self._outbox(db, 'bookings', 'append', booking_id, booking_row(slot, expert_name, client_name))
+
+    def imported(self):
+        """Загружены ли эксперты из листа."""
+        return bool(self._db().execute("SELECT value FROM meta WHERE key = 'experts_imported'").fetchone()[0])
+
+    def import_experts(self, ws):
+        """Один раз загружает экспертов из листа; отметка хранится в meta.
+
+        Строки, номер которых уже есть в базе (sheet_row), пропускаются:
+        так импорт не задваивает экспертов, зарегистрированных и
+        отреплицированных до него.
+        """
+        if self.imported():
+            return 0
+        data = ws.get_all_values()
+        header = data[0] if data else []
+        positions = {h: i for i, h in enumerate(header)}
+        imported = 0
+        with self.write() as db:
+            if db.execute("SELECT value FROM meta WHERE key = 'experts_imported'").fetchone()[0]:
+                return 0
+            known = {r[0] for r in db.execute('SELECT sheet_row FROM experts WHERE sheet_row IS NOT NULL')}
+            for row_num, values in enumerate(data[1:], 2):
+                if row_num in known:
+                    continue
+                record = [
+                    values[positions[h]] if h in positions and positions[h] < len(values) else ''
+                    for _, h in EXPERT_COLUMNS
+                ]
+                db.execute(
+                    f"INSERT INTO experts (sheet_row, {', '.join(c for c, _ in EXPERT_COLUMNS)}) "
+                    f"VALUES (?, {', '.join('?' * len(EXPERT_COLUMNS))})",
+                    [row_num] + record,
+                )
+                imported += 1
+            db.execute("UPDATE meta SET value = 1 WHERE key = 'experts_imported'")
+            if imported:
+                self._bump(db)
+        return imported
+
+
+class SheetsReplicator:
+    """Переносит изменения из outbox в листы Google пачками.
+
+    Добавления уходят одним append_rows на лист, обновления ячеек — одним
+    batch_update (для ячейки остаётся последнее значение). Реплицирует один
+    процесс: тот, кто держит файловую блокировку рядом с базой. Перед первой
+    пачкой он загружает экспертов из листа (import_experts); пока импорт
+    не удался, outbox в листы не отправляется.
+    """
+
+    def __init__(self, repo, interval=REPLICATION_INTERVAL, batch=REPLICATION_BATCH):
+        self.repo = repo
+        self.interval = interval
+        self.batch = batch
+        self.worksheets = {table: _worksheet(table) for table in TABLES}
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='sheets-replicator', daemon=True).start()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def _run(self):
+        with open(self.repo.path + '.replicator.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            while True:
+                try:
+                    self.repo.import_experts(self.worksheets['experts'])
+                except Exception:
+                    log.exception('Не удалось загрузить экспертов из листа, повторим позже')
+                else:
+                    try:
+                        while self.run_once() == self.batch:
+                            pass
+                    except Exception:
+                        log.exception('Репликация в Google Sheets не удалась, повторим позже')
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+    def run_once(self):
+        """Одна пачка outbox; результат — число перенесённых в листы записей."""
+        with self.repo.read() as db:
+            entries = db.execute(
+                'SELECT id, tbl, op, ref, payload FROM outbox ORDER BY id LIMIT ?', (self.batch,)
+            ).fetchall()
+        if not entries:
+            return 0
+        done = 0
+        # сначала добавления: обновлениям нужны номера строк новых экспертов;
+        # каждая пачка удаляется из outbox сразу после записи, чтобы сбой
+        # следующей не отправил её в лист повторно
+        for table in TABLES:
+            appends = [e for e in entries if e[1] == table and e[2] == 'append']
+            if appends:
+                self._append(table, appends)
+                done += len(appends)
+        updates = [e for e in entries if e[2] == 'update']
+        if updates:
+            done += self._update(updates)
+        return done
+
+    @staticmethod
+    def _done(db, ids):
+        db.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in ids])
+
+    def _append(self, table, appends):
+        res = self.worksheets[table].append_rows([json.loads(e[4]) for e in appends])
+        m = ROW_RE.search((res or {}).get('updates', {}).get('updatedRange', ''))
+        with self.repo.write() as db:
+            if table == 'experts' and m:
+                db.executemany(
+                    'UPDATE experts SET sheet_row = ? WHERE id = ?',
+                    [(row_num, e[3]) for row_num, e in enumerate(appends, int(m.group(1)))],
+                )
+            self._done(db, [e[0] for e in appends])
+
+    def _sheet_rows(self, refs):
+        """Строки экспертов refs в листе, сверенные со столбцом Telegram ID.
+
+        Люди сортируют, вставляют и удаляют строки, поэтому sheet_row
+        проверяется по листу; сдвинувшийся эксперт ищется по Telegram ID,
+        и новый номер сохраняется в базе. Результат — (ref -> номер строки,
+        эксперты, которых в листе больше нет).
+        """
+        with self.repo.read() as db:
+            experts = {r[0]: (r[1], str(r[2]).strip()) for r in db.execute(
+                f"SELECT id, sheet_row, telegram_id FROM experts WHERE id IN ({', '.join('?' * len(refs))})", refs
+            )}
+        column = rowcol_to_a1(1, TELEGRAM_ID_COL)[:-1]
+        values = self.worksheets['experts'].get(f'{column}:{column}', key=None) or []
+        ids = [str(v[0]).strip() if v else '' for v in values]
+        rows, moved, gone = {}, [], set()
+        for ref, (sheet_row, tg) in experts.items():
+            if not sheet_row:
+                continue  # строки эксперта ещё нет в листе — попробуем в следующий раз
+            if sheet_row <= len(ids) and ids[sheet_row - 1] == tg:
+                rows[ref] = sheet_row
+            elif tg and tg in ids:
+                rows[ref] = ids.index(tg) + 1
+                moved.append((rows[ref], ref))
+            else:
+                gone.add(ref)
+        if moved:
+            with self.repo.write() as db:
+                db.executemany('UPDATE experts SET sheet_row = ? WHERE id = ?', moved)
+        return rows, gone
+
+    def _update(self, updates):
+        # по каждой ячейке отправляется только последнее значение
+        cells = {}
+        for entry_id, _, _, ref, payload in updates:
+            payload = json.loads(payload)
+            ids, _ = cells.get((ref, payload['col']), ([], None))
+            cells[(ref, payload['col'])] = (ids + [entry_id], payload['value'])
+        rows, gone = self._sheet_rows(sorted({ref for ref, _ in cells}))
+        data, done = [], []
+        for (ref, col), (ids, value) in cells.items():
+            row_num = rows.get(ref)
+            if row_num:
+                data.append({'range': rowcol_to_a1(row_num, col), 'values': [[value]]})
+            elif ref not in gone:
+                continue
+            done += ids
+        if gone:
+            log.warning('Эксперты %s не найдены в листе по Telegram ID, их обновления пропущены', sorted(gone))
+        if data:
+            self.worksheets['experts'].batch_update(data)
+        with self.repo.write() as db:
+            self._done(db, done)
+        return len(done)
+
+
+def open_repository(backend=STORAGE_BACKEND):
+    if backend == 'sqlite':
+        return SqliteRepository()
+    if backend == 'sheets':
+        return SheetsRepository()
+    raise RuntimeError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import pytest
+
+# Окружение — до импорта модулей проекта: они читают его при импорте
+TMP = tempfile.mkdtemp(prefix='kons-tests-')
+os.environ.update({
+    'SHEET_ID': 'test-sheet',
+    'DRIVE_FOLDER_ID': 'test-folder',
+    'GSPREAD_CREDENTIALS_JSON': '{}',
+    'SHEETS_REQUESTS_PER_MINUTE': '60000',
+    'GOOGLE_CACHE_DIR': os.path.join(TMP, 'google_cache'),
+    'JOURNAL_DIR': os.path.join(TMP, 'journal'),
+    'LEDGER_PATH': os.path.join(TMP, 'bookings.db'),
+    'SQLITE_PATH': os.path.join(TMP, 'kons.db'),
+    'PHOTO_SPOOL_DIR': os.path.join(TMP, 'spool'),
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EXPERT_HEADER = ['ФИО эксперта', 'Город', 'сфера', 'описание', 'photo_file_id', 'Telegram ID', 'Username', 'Slots']
+FIRST_EXPERT_ID = 10000
+
+
+def tomorrow():
+    return (date.today() + timedelta(days=1)).strftime('%d.%m.%y')
+
+
+def make_sheets(experts=3, hours=('10:00', '11:00', '12:00')):
+    """Листы таблицы: experts экспертов со слотами на завтра."""
+    day = tomorrow()
+    rows = [EXPERT_HEADER] + [
+        [f'Эксперт {i}', 'Москва', 'IT', '', '', str(FIRST_EXPERT_ID + i), f'expert{i}',
+         ';'.join(f'{day} {h}' for h in hours)]
+        for i in range(experts)
+    ]
+    return {'Эксперты': rows, 'Users': [['Имя', 'Город']], 'Заявки': [['ФИО', 'эксперт', 'дата', 'время']]}
+
+
+@pytest.fixture
+def backends():
+    """Заменители Google и Telegram с чистыми листами; клиенты процесса создаются заново."""
+    import fakes
+    import google_clients
+    google_clients._state.clear()
+    yield fakes.FakeBackends(sheets=make_sheets()).install()
+    google_clients._state.clear()
+
+
+@pytest.fixture
+def expert_rows(backends):
+    return backends.spreadsheet.sheets['Эксперты']['rows']
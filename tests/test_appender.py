@@ -0,0 +1,73 @@
+import os
+import json
+import glob
+
+from appender import AppendWriter
+
+
+class FileSheet:
+    """Лист, который пишет строки в файл: его видно и из дочернего процесса."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def append_rows(self, rows):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+
+    def rows(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+
+def _crash_after(sheet, journal_dir, sent, unsent, torn=False):
+    """Дочерний процесс пишет строки, часть отправляет и падает, не отправив остальное."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            writer = AppendWriter(sheet, 'test', journal_dir=journal_dir, batch_size=1000, interval=3600)
+            for row in sent:
+                writer.append(row)
+            writer.flush()
+            for row in unsent:
+                writer.append(row)
+            if torn:
+                writer._file.write('{"row": ["обрыв"')
+                writer._file.flush()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def test_journal_replay_after_crash(tmp_path):
+    sheet = FileSheet(str(tmp_path / 'sheet.jsonl'))
+    journal_dir = str(tmp_path / 'journal')
+    sent = [['a', '1'], ['b', '2']]
+    unsent = [['c', '3'], ['d', '4'], ['e', '5']]
+    _crash_after(sheet, journal_dir, sent, unsent)
+    assert sheet.rows() == sent
+
+    writer = AppendWriter(sheet, 'test', journal_dir=journal_dir, batch_size=1000, interval=3600)
+    writer.start()
+    writer.flush()
+    assert sheet.rows() == sent + unsent
+    # журнал упавшего процесса забран и удалён, повторный старт ничего не дописывает
+    assert len(glob.glob(os.path.join(journal_dir, 'test-*.jsonl'))) == 1
+    other = AppendWriter(sheet, 'test', journal_dir=journal_dir, batch_size=1000, interval=3600)
+    other.start()
+    other.flush()
+    assert sheet.rows() == sent + unsent
+
+
+def test_journal_replay_skips_torn_line(tmp_path):
+    sheet = FileSheet(str(tmp_path / 'sheet.jsonl'))
+    journal_dir = str(tmp_path / 'journal')
+    _crash_after(sheet, journal_dir, [], [['x']], torn=True)
+
+    writer = AppendWriter(sheet, 'test', journal_dir=journal_dir, batch_size=1000, interval=3600)
+    writer.start()
+    writer.flush()
+    assert sheet.rows() == [['x']]
@@ -0,0 +1,56 @@
+import io
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import google_clients
+from photos import PhotoQueue, DONE
+
+
+def _photo():
+    out = io.BytesIO()
+    Image.new('RGB', (64, 48), 'red').save(out, 'PNG')
+    out.seek(0)
+    return FileStorage(out, filename='photo.png')
+
+
+def _queue(spool, on_done):
+    return PhotoQueue(lambda: google_clients.build_drive(), 'folder', on_done, spool_dir=str(spool), workers=1)
+
+
+def test_registration_replays_after_failure(backends, tmp_path):
+    calls = []
+
+    def failing(payload, photo_url, retry):
+        calls.append((payload['fio'], retry))
+        raise RuntimeError('storage is down')
+
+    queue = _queue(tmp_path, failing)
+    job_id = queue.submit(_photo(), {'fio': 'Эксперт'})
+    queue._executor.shutdown(wait=True)
+    assert queue.status(job_id)['registered'] is False
+    uploads = backends.drive.total()
+
+    def register(payload, photo_url, retry):
+        calls.append((payload['fio'], retry))
+
+    restarted = _queue(tmp_path, register)
+    restarted.start()
+    restarted._executor.shutdown(wait=True)
+    state = restarted.status(job_id)
+    assert state['state'] == DONE and state['registered'] is True
+    # повтор знает, что прошлая регистрация могла успеть
+    assert calls == [('Эксперт', False), ('Эксперт', True)]
+    # фото повторно не загружается
+    assert backends.drive.total() == uploads
+
+
+def test_registration_runs_once(backends, tmp_path):
+    calls = []
+    queue = _queue(tmp_path, lambda payload, photo_url, retry: calls.append(retry))
+    queue.submit(_photo(), {'fio': 'Эксперт'})
+    queue._executor.shutdown(wait=True)
+    restarted = _queue(tmp_path, lambda payload, photo_url, retry: calls.append(retry))
+    restarted.start()
+    restarted._executor.shutdown(wait=True)
+    assert calls == [False]
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+import storage
+from slots import BOOKED
+from conftest import FIRST_EXPERT_ID, tomorrow
+
+
+class BrokenSheet:
+    def append_rows(self, rows):
+        raise ConnectionError('sheet is down')
+
+
+@pytest.fixture
+def repo(backends, tmp_path):
+    repo = storage.SqliteRepository(path=str(tmp_path / 'kons.db'))
+    repo.import_experts(storage._worksheet('experts'))
+    return repo
+
+
+def _outbox(repo):
+    with repo.read() as db:
+        return db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+
+def test_failed_append_does_not_repeat_other_tables(repo, expert_rows):
+    repo.append('experts', ['Новый', 'Москва', 'IT', '', '', str(FIRST_EXPERT_ID + 50), 'new', ''])
+    repo.append('users', ['Клиент', 'Москва'])
+    repo.replicator.worksheets['users'] = BrokenSheet()
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            repo.replicator.run_once()
+    assert [r[5] for r in expert_rows].count(str(FIRST_EXPERT_ID + 50)) == 1
+    assert _outbox(repo) == 1
+
+
+def test_start_does_not_wait_for_google(backends, tmp_path):
+    repo = storage.SqliteRepository(path=str(tmp_path / 'offline.db'), replicate=False)
+    repo.start()
+    assert backends.sheets.total() == 0
+    assert not repo.imported()
+
+
+def test_replicator_imports_experts(backends, tmp_path):
+    repo = storage.SqliteRepository(path=str(tmp_path / 'kons.db'))
+    repo.start()
+    deadline = time.monotonic() + 10
+    while not repo.imported() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert repo.imported()
+    assert repo.experts.find(FIRST_EXPERT_ID)[0] is not None
+
+
+def test_update_follows_shifted_row(repo, expert_rows):
+    assert repo.book_slot(FIRST_EXPERT_ID + 2, tomorrow(), '10:00') == BOOKED
+    repo.replicator.run_once()
+    # человек удалил строку выше: sheet_row эксперта теперь указывает на чужую строку
+    del expert_rows[1]
+    before = list(expert_rows[1])
+    assert repo.book_slot(FIRST_EXPERT_ID + 2, tomorrow(), '11:00') == BOOKED
+    repo.replicator.run_once()
+    assert expert_rows[1] == before
+    assert expert_rows[2][7] == f'{tomorrow()} 12:00'
+    assert _outbox(repo) == 0
@@ -0,0 +1,52 @@
+import random
+from datetime import date
+
+import pytest
+
+import slot_picker
+from slot_picker import DATES_AHEAD, HOURS, PickerState, decode, encode
+
+ACTIONS = ['d', 'D', 'T', 'X', 'w', 'W', 'B', 'h', 'C', 'n']
+FULL = PickerState(date(2099, 12, 31).toordinal(), (1 << DATES_AHEAD) - 1, (1 << 7) - 1, (1 << len(HOURS)) - 1)
+
+
+def _states():
+    rnd = random.Random(1)
+    yield PickerState.new()
+    yield FULL
+    for _ in range(200):
+        yield PickerState(
+            PickerState.new().base + rnd.randrange(-1000, 1000),
+            rnd.getrandbits(DATES_AHEAD), rnd.getrandbits(7), rnd.getrandbits(len(HOURS)),
+        )
+
+
+@pytest.mark.parametrize('action', ACTIONS)
+def test_encode_decode_round_trip(action):
+    for state in _states():
+        assert decode(encode(action, state)) == (action, None, state)
+        for arg in (0, 13, 99):
+            assert decode(encode(action, state, arg)) == (action, arg, state)
+
+
+@pytest.mark.parametrize('data', [
+    None, '', 'slot_1', 't:d::1:0:0', 't:d:1:2:3',
+    encode('d', FULL._replace(dates=1 << DATES_AHEAD)),
+    encode('d', FULL._replace(weekdays=1 << 7)),
+    encode('d', FULL._replace(hours=1 << len(HOURS))),
+])
+def test_decode_rejects_foreign_data(data):
+    with pytest.raises(ValueError):
+        decode(data)
+
+
+@pytest.mark.parametrize('keyboard', [
+    slot_picker.date_keyboard, slot_picker.weekday_keyboard, slot_picker.hour_keyboard, slot_picker.weeks_keyboard,
+])
+def test_callback_data_fits_telegram_limit(keyboard):
+    for state in (PickerState.new(), FULL):
+        buttons = [b for row in keyboard(state).inline_keyboard for b in row]
+        assert buttons
+        for button in buttons:
+            assert len(button.callback_data.encode('utf-8')) <= 64
+            decode(button.callback_data)
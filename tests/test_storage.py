@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+import storage
+from slots import BOOKED, TAKEN, NOT_FOUND
+from conftest import FIRST_EXPERT_ID, tomorrow
+
+
+@pytest.fixture(params=['sheets', 'sqlite'])
+def repo(request, backends, tmp_path):
+    if request.param == 'sheets':
+        repo = storage.SheetsRepository()
+    else:
+        repo = storage.SqliteRepository(path=str(tmp_path / 'kons.db'), replicate=False)
+        repo.import_experts(storage._worksheet('experts'))
+    repo.start()
+    return repo
+
+
+def _slots_of(rows, telegram_id):
+    row = next(r for r in rows if r[5] == str(telegram_id))
+    return row[7].split(';') if row[7] else []
+
+
+def test_concurrent_booking_gives_slot_once(repo):
+    threads = 10
+    barrier = threading.Barrier(threads)
+    results = []
+
+    def book():
+        barrier.wait()
+        results.append(repo.book_slot(FIRST_EXPERT_ID, tomorrow(), '11:00'))
+
+    workers = [threading.Thread(target=book) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    assert sorted(results) == sorted([BOOKED] + [TAKEN] * (threads - 1))
+    assert repo.book_slot(FIRST_EXPERT_ID, tomorrow(), '10:00') == BOOKED
+    assert repo.book_slot(FIRST_EXPERT_ID + 99, tomorrow(), '10:00') == NOT_FOUND
+    assert repo.book_slot(FIRST_EXPERT_ID, tomorrow(), '25:00') == TAKEN
+    assert repo.book_slot(FIRST_EXPERT_ID, 'завтра', '10:00') == TAKEN
+
+
+def test_concurrent_booking_of_different_slots(repo):
+    hours = ['10:00', '11:00', '12:00']
+    results = {}
+    barrier = threading.Barrier(len(hours))
+
+    def book(hour):
+        barrier.wait()
+        results[hour] = repo.book_slot(FIRST_EXPERT_ID + 1, tomorrow(), hour)
+
+    workers = [threading.Thread(target=book, args=(h,)) for h in hours]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    assert results == {h: BOOKED for h in hours}
+
+
+def test_sheet_booking_follows_shifted_row(expert_rows):
+    repo = storage.SheetsRepository()
+    repo.start()
+    assert repo.book_slot(FIRST_EXPERT_ID + 2, tomorrow(), '10:00') == BOOKED
+    # человек удалил строку выше: кэшированный номер строки теперь чужой
+    del expert_rows[1]
+    before = _slots_of(expert_rows, FIRST_EXPERT_ID + 1)
+    assert repo.book_slot(FIRST_EXPERT_ID + 2, tomorrow(), '11:00') == BOOKED
+    assert _slots_of(expert_rows, FIRST_EXPERT_ID + 1) == before
+    assert _slots_of(expert_rows, FIRST_EXPERT_ID + 2) == [f'{tomorrow()} 12:00']
+
+
+def test_booking_keeps_unparsed_entries(expert_rows):
+    expert_rows[1][7] += ';10.10.2025 10:00;по договорённости'
+    repo = storage.SheetsRepository()
+    repo.start()
+    assert repo.book_slot(FIRST_EXPERT_ID, tomorrow(), '10:00') == BOOKED
+    assert _slots_of(expert_rows, FIRST_EXPERT_ID)[-2:] == ['10.10.2025 10:00', 'по договорённости']
@@ -0,0 +1,160 @@
+import os
+import hmac
+import json
+import time
+import asyncio
+import logging
+import functools
+import tornado.web
+from telegram import Update
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+import metrics
+
+# Сколько обновлений обрабатывается одновременно и сколько может ждать в очереди
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+
+log = logging.getLogger(__name__)
+
+
+def chat_key(update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """Ограниченная очередь входящих обновлений с N обработчиками.
+
+    Очередь разбита на N частей по chat id: обновления одного чата всегда
+    попадают к одному обработчику и идут строго по порядку (на этом держится
+    ConversationHandler), а разные чаты обрабатываются параллельно.
+    Если часть очереди заполнена, submit() возвращает False — вебхук отвечает
+    503, и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, application, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.application = application
+        per_worker = max(1, queue_size // workers)
+        self._queues = [asyncio.Queue(maxsize=per_worker) for _ in range(workers)]
+        self._tasks = []
+        metrics.queue('webhook', self.qsize)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def submit(self, update):
+        queue = self._queues[hash(chat_key(update)) % len(self._queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception:
+                log.exception('Ошибка при обработке обновления %s', update.update_id)
+            finally:
+                queue.task_done()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def stop(self):
+        # дорабатываем то, что уже принято
+        for q in self._queues:
+            await q.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# --- Метрики ---
+class TelegramRequest(HTTPXRequest):
+    """HTTPXRequest, который учитывает каждый вызов Bot API в metrics."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        name = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+            status = metrics.status_of(code)
+            return code, payload
+        finally:
+            metrics.external_call('telegram', name, time.perf_counter() - started, status)
+
+
+def _timed(callback):
+    @functools.wraps(callback)
+    async def timed(update, context):
+        with metrics.timed_handler('bot', callback.__name__):
+            return await callback(update, context)
+    return timed
+
+
+def instrument_handlers(application):
+    """Оборачивает колбэки всех обработчиков (и внутри ConversationHandler) замером времени."""
+    def walk(handlers):
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                walk(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    walk(state_handlers)
+                walk(handler.fallbacks)
+            else:
+                handler.callback = _timed(handler.callback)
+
+    for handlers in application.handlers.values():
+        walk(handlers)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(metrics.render())
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("OK")
+
+    def head(self):
+        self.set_status(200)
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, dispatcher, secret_token):
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token
+
+    def post(self):
+        token = self.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), self.secret_token.encode('utf-8')):
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        update = Update.de_json(data, self.dispatcher.application.bot)
+        if not self.dispatcher.submit(update):
+            self.set_header('Retry-After', '1')
+            raise tornado.web.HTTPError(503)
+        self.set_status(200)
+
+
+def make_app(dispatcher=None, webhook_path='/telegram', secret_token=None):
+    """HTTP-приложение бота: health-check, /metrics и, если задан dispatcher, приём вебхука."""
+    routes = [(r'/', HealthHandler), (r'/metrics', MetricsHandler)]
+    if dispatcher is not None:
+        if not secret_token:
+            raise ValueError('Вебхук без secret_token принимал бы поддельные обновления')
+        routes.append((webhook_path, WebhookHandler, {'dispatcher': dispatcher, 'secret_token': secret_token}))
+    return tornado.web.Application(routes)